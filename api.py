@@ -5,293 +5,539 @@
 # The scraping functions in this file collect data that needs little to no manipulation,
 # And other data from the scrape file is sent here to be manipulated and organized
 
-import pickle
+import numpy as np
 import pandas as pd
-import requests
-from os.path import exists
-from json import loads
 
-import yfinance as yf
+import atexit
 import datetime
+import threading
+import functools
 import pytz
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from requests_futures.sessions import FuturesSession
-from bs4 import BeautifulSoup
 
-from tqdm import tqdm
+import arrays
+import bars
+import fetch
+import metrics
+import parsing
+import quotes
+import scheduler
 import scrape
+import stats
+import store
 
 
-# Metaclass makes it easier to organize and pickle the file
+# Metaclass makes it easier to organize and store the data
 # Helps coordination
 class SPData(metaclass=scrape.Singleton):
     # Ensure Timezone is correct
     _EASTERN_TZ = pytz.timezone('US/Eastern')
     # Plan a timeout if scrape/program takes too long
     _TIMEOUT = 300
-
-    def __init__(self):
-        self.companies = scrape.CurrentSPXCompanies().companies
-
-        # ThreadPoolExecutor and Futures allow for multiple tasks to run at once
-        self._pool = ThreadPoolExecutor(max_workers=8)
-        self._session = FuturesSession()
-
-        # Run the earnings dates scraper from scrape file
-        earnings_instance = scrape.EarningsDates()
-
-        # use a pickle file to store data dict
-        self.sp_dict = {}
-        if exists('sp_dict.pickle'):
-            self.sp_dict = pickle.load(open('sp_dict.pickle', 'rb'))
+    # Worker threads per site for the refresh tasks, Zacks requests are also rate limited in scrape.py
+    _POOLS = {'zacks': 32, 'marketwatch': 8}
+    # Symbols per price download, the same as a Yahoo multi ticker download
+    _PRICE_BATCH = 100
+    # Columns of the daily price bars and of the per symbol earnings tables
+    _BAR_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+    _TABLE_COLUMNS = ['Date', 'Open_Pre', 'High_Pre', 'Low_Pre', 'Close_Pre', 'Volume_Pre',
+                      'Dividends_Pre', 'Stock Splits_Pre', 'Date_Pre', 'Open_Post',
+                      'High_Post', 'Low_Post', 'Close_Post', 'Volume_Post', 'Dividends_Post',
+                      'Stock Splits_Post', 'Date_Post', 'Point_Change', 'Percent_Change']
+    # Seconds between symbols in the combined search key, wider than any price history
+    _SYMBOL_SPAN = 10 ** 11
+    # Reports this many days old or newer wait for their price bars instead of being stored without them
+    _PENDING_DAYS = 10
+
+    # Loads the last stored snapshot only, call refresh() to run the scraping pipeline
+    # price_source is anything with a histories(windows) method, see scrape.YahooPriceHistory
+    def __init__(self, price_source=None):
+        # Daily prices come from batched multi ticker downloads unless another source is given
+        # Every price read goes through the local bar cache, so only missing date ranges are downloaded
+        self._bars = bars.BarCache(price_source or scrape.YahooPriceHistory())
+        self._price_source = self._bars
+
+        # use a SQLite store for the data dict
+        # Only symbols changed by a refresh are written back
+        self._store = store.SPStore()
+        self.sp_dict = self._store.load()
+        # Changed symbols are written in batches, and whatever is left when the program exits
+        self._writer = store.WriteBehind(self._store, self.sp_dict)
+        atexit.register(self.flush)
+        # Precomputed earnings reaction statistics, {symbol: {n: {metric: value}}}
+        self.stats = self._store.load_stats()
+        self._on_update = None
+
+        # Last known S&P 500 companies until refresh() scrapes the current list
+        self.companies = self._store.load_companies()
+        if len(self.companies) == 0:
+            self.companies = [{'symbol': _, 'name': ''} for _ in sorted(self.sp_dict)]
+
+    # Run the whole update pipeline: Wikipedia, Zacks earnings, next earnings, prices and details
+    # on_update(symbol) is called as soon as a symbol's data has changed
+    # reporters are the symbols whose next earnings date had passed, see refresh_graph
+    def refresh(self, on_update=None, reporters=None):
+        self._on_update = on_update
+        recorder = metrics.shared_metrics()
+        with recorder.stage('refresh'):
+            self._refresh(recorder, reporters)
+        self._on_update = None
+        # Where the time went, see metrics.py for the full counters
+        print("\n\nRefresh stages:\n\n" + recorder.summary())
+
+    def _refresh(self, recorder, reporters):
+        with recorder.stage('companies'):
+            # Scraped again every refresh, the list object is kept so CompanyInfo and the GUI see the new companies
+            self.companies[:] = scrape.current_spx_companies()
+            self._store.save_companies(self.companies)
 
         # Store current S&P 500 Tickers
         current_symbols = [_['symbol'] for _ in self.companies]
 
         # Remove companies no longer in index
-        for symbol in [_ for _ in self.sp_dict]:
-            if symbol not in current_symbols:
-                del self.sp_dict[symbol]
-
-        # Update earnings for companies with earnings in the next 15 days
-        # Earnings dates can change
-        self.update_upcoming_earnings(15)
+        removed = [_ for _ in self.sp_dict if _ not in current_symbols]
+        for symbol in removed:
+            del self.sp_dict[symbol]
+        self._store.remove(removed)
+        self._writer.discard(removed)
+        for symbol in removed:
+            self._notify(symbol)
+
+        # Every symbol's earnings pages, prices and details run as one task graph,
+        # so each symbol moves on as soon as its own pages are in instead of waiting for every other symbol
+        print("\n\nUpdating earnings, prices and company details:\n\n")
+        with recorder.stage('tasks'):
+            self.refresh_graph(current_symbols, reporters).run()
+
+        # Recompute the statistics for every symbol in one pass
+        with recorder.stage('stats'):
+            self.update_stats()
+
+        with recorder.stage('save'):
+            # Write what is still waiting from this refresh
+            self.flush()
+            # Next start maps the new tables straight from the snapshot
+            self._store.save_snapshot(self.sp_dict)
+
+    # Task graph of one refresh, per symbol:
+    #     earnings page (Zacks) -> price bars (Yahoo, batched) -> table and averages
+    #     next earnings page (Zacks) -> stored next earnings date
+    #     company detail (MarketWatch) -> stored detail
+    # Only the table and store updates touch sp_dict, and they run on the thread calling run()
+    # reporters are the symbols to look for new earnings reports, by default the ones whose stored
+    # next earnings date has passed; callers that update next earnings dates first must collect them before that
+    def refresh_graph(self, current_symbols, reporters=None):
+        earnings_instance = scrape.EarningsDates()
+        graph = scheduler.TaskGraph(self._POOLS, timeout=self._TIMEOUT)
+        # Price downloads are batched across symbols, the earliest symbols don't wait for the last earnings page
+        prices = scheduler.Batcher(self.bulk_daily_prices, size=self._PRICE_BATCH)
 
-        # New S&P 500 companies var
+        # Companies with recent earnings reports date updates
+        # Found before next earnings dates are refreshed, which moves them into the future
+        recent_earnings_companies = [_ for _ in (self.passed_next_earnings() if reporters is None else reporters)
+                                     if _ in self.sp_dict]
+        # Update earnings dates for companies whose date passed or is missing, earnings dates can change
+        upcoming = recent_earnings_companies + [
+            _ for _ in self.sp_dict if len(self.sp_dict[_].get('next_earnings', [])) == 0]
         new_companies = [_ for _ in current_symbols if _ not in self.sp_dict]
 
-        # Companies with recent earnings reports date updates
-        # Add these dates to dict
-        recent_earnings_companies = []
-        for symbol in self.sp_dict:
-            try:
-                earnings_date = self.sp_dict[symbol].get('next_earnings', [])
-                if len(earnings_date) > 0:
-                    now = datetime.datetime.now(tz=self._EASTERN_TZ)
-                    if earnings_date[0] < now:
-                        recent_earnings_companies.append(symbol)
-            except:
-                continue
-
-        # Updates companies that need it
-        companies_to_update = [*new_companies, *recent_earnings_companies]
-
-        # Adding Earnings Dates for new companies
-        print("\n\nUpdating company earnings:\n\n")
-        earnings = earnings_instance.earnings(companies_to_update)
-        print("\n\nUpdating company earnings dates:\n\n")
-        next_earnings_dates = earnings_instance.next_earnings(companies_to_update)
-        # merge earnings dates with new_earnings dates and update sp_dict
+        # Companies still waiting for the prices of a report are looked at again until they come in
+        pending = [_ for _ in self.sp_dict if len(self.sp_dict[_].get('pending_earnings', [])) > 0]
+
+        # Companies that already have a table only need announcements after their latest stored one
+        latest_earnings = {}
+        for symbol in dict.fromkeys(recent_earnings_companies + pending):
+            table = self.sp_dict[symbol].get('table')
+            # A new company whose reports are all still pending starts over from the last 10
+            if table is not None and (len(table) > 0 or symbol in pending):
+                latest_earnings[symbol] = table.latest_date()
+
+        for symbol in [*upcoming, *new_companies]:
+            graph.add(('next_earnings', symbol), functools.partial(earnings_instance.next_earnings_by_symbol, symbol),
+                      pool='zacks', stage='next_earnings', symbol=symbol)
+        for symbol in upcoming:
+            graph.add(('store_next_earnings', symbol), functools.partial(self._store_next_earnings, symbol),
+                      after=[('next_earnings', symbol)], symbol=symbol)
+
+        # Recent reporters keep their stored events and only add the new ones
+        for symbol in latest_earnings:
+            graph.add(('earnings', symbol),
+                      functools.partial(self._new_earnings, earnings_instance, symbol, latest_earnings[symbol]),
+                      pool='zacks', stage='earnings', symbol=symbol)
+            graph.add(('prices', symbol), functools.partial(self._batch_prices, prices, symbol),
+                      after=[('earnings', symbol)], stage='prices', symbol=symbol)
+            graph.add(('table', symbol), functools.partial(self._extend_table, symbol, 10),
+                      after=[('prices', symbol)], symbol=symbol)
+
+        # New companies get their last 10 reports
         for symbol in new_companies:
-            dates = earnings.get(symbol, [])[:10]
-            table = (self.daily_prices(symbol, dates))
-            self.sp_dict[symbol] = {
-                'earnings': dates,
-                'next_earnings': next_earnings_dates.get(symbol, []),
-                'table': table,
-                'avg': self.avg_price(table, 10)
-            }
-
-        futures = []
-        # make sure all averages and tables are up to date
-        for symbol in self.sp_dict:
-            info = self.sp_dict[symbol]
-            if 'earnings' in info and 'table' not in info:
-                dates = info['earnings']
-                future = self._pool.submit(self.daily_prices, symbol, dates)
-                future.symbol = symbol
-                futures.append(future)
-
-        # Create progress bar for updating
-        progress_bar = tqdm(total=len(futures))
-        print("\n\nUpdating price data and averages:\n\n")
-        try:
-            for future in as_completed(futures, timeout=self._TIMEOUT):
-
-                # Update console progress bar
-                progress_bar.set_description(future.symbol)
-                progress_bar.update()
-                # Update table with results
-                table = future.result()
-                symbol = future.symbol
-                # Use Pandas DataFrame with table data
-                if isinstance(table, pd.DataFrame):
-                    self.sp_dict[symbol] = {
-                        **self.sp_dict[symbol],
-                        'table': table,
-                        'avg': self.avg_price(table, 10)
-                    }
-        except:
-            pass
-
-        # Get company details and update in pickle
-        futures = []
-        for symbol in self.sp_dict:
-            # Update company details as needed
-            if not 'detail' in self.sp_dict[symbol]:
+            graph.add(('earnings', symbol), functools.partial(self._new_earnings, earnings_instance, symbol, None),
+                      pool='zacks', stage='earnings', symbol=symbol)
+            graph.add(('prices', symbol), functools.partial(self._batch_prices, prices, symbol),
+                      after=[('earnings', symbol)], stage='prices', symbol=symbol)
+            graph.add(('table', symbol), functools.partial(self._new_table, symbol),
+                      after=[('prices', symbol), ('next_earnings', symbol)], symbol=symbol)
+
+        # Company details only need the symbol, so they download alongside everything else
+        for symbol in [*[_ for _ in self.sp_dict if 'detail' not in self.sp_dict[_]], *new_companies]:
+            # A detail that doesn't arrive in time stays empty
+            if symbol in self.sp_dict:
                 self.sp_dict[symbol]['detail'] = ''
-                # Using pool with futures to help designate the simultaneous tasks
-                future = self._pool.submit(
-                    self.market_watch_company_detail, symbol)
-                future.symbol = symbol
-                # Append company details
-                futures.append(future)
-
-        print("\n\nGetting company details:\n\n")
-        # Company details progress bar
-        progress_bar = tqdm(total=len(futures))
-        try:
-            for future in as_completed(futures, timeout=self._TIMEOUT):
-                # Update console progress bar
-                progress_bar.set_description(future.symbol)
-                progress_bar.update()
-                # Getting details
-                detail = future.result()
-                symbol = future.symbol
-                if isinstance(detail, str):
-                    self.sp_dict[symbol]['detail'] = detail
-        except:
-            pass
-
-        # Append info for symbols that need updating in dict
+            graph.add(('detail', symbol), functools.partial(self.market_watch_company_detail, symbol),
+                      pool='marketwatch', stage='details', symbol=symbol)
+            graph.add(('store_detail', symbol), functools.partial(self._store_detail, symbol),
+                      after=[('detail', symbol)] + ([('table', symbol)] if symbol in new_companies else []),
+                      symbol=symbol)
+        return graph
+
+    # Symbols whose stored next earnings date has passed
+    def passed_next_earnings(self):
+        now = datetime.datetime.now(tz=self._EASTERN_TZ)
+        passed = []
         for symbol in self.sp_dict:
-            info = self.sp_dict[symbol]
-            info['table']['Date'] = pd.Series(self.sp_dict[symbol]['earnings'])
-            info['table'].set_index('Date')
-        # Dump pickle data for s&p dict
-        pickle.dump(self.sp_dict, open('sp_dict.pickle', 'wb'))
+            earnings_date = self.sp_dict[symbol].get('next_earnings', [])
+            if len(earnings_date) > 0 and earnings_date[0] < now:
+                passed.append(symbol)
+        return passed
+
+    # Earnings dates from a symbol's Zacks page, only the ones after since if given, at most the last 10
+    # A missing page fails the task, so the symbol's table and pending reports are left alone
+    def _new_earnings(self, earnings_instance, symbol, since):
+        dates = earnings_instance.earnings_by_symbol(symbol)
+        if dates is None:
+            raise LookupError('no earnings page')
+        if since is not None:
+            dates = [_ for _ in dates if _ > since]
+        return dates[:10]
+
+    # Future of the earnings table for the dates, None if there are no dates
+    def _batch_prices(self, prices, symbol, dates):
+        if len(dates) == 0:
+            return None
+        return prices.submit(symbol, dates)
+
+    # No table means the earnings page lists no reports, an empty one is a failed price download:
+    # the company is then left out so the next refresh tries it again as a new company
+    def _new_table(self, symbol, table, next_earnings):
+        if table is not None and len(table) == 0:
+            return
+        if table is None:
+            table = pd.DataFrame(columns=self._TABLE_COLUMNS)
+        table, pending = self._complete_events(table)
+        table = arrays.EarningsView.from_frame(table)
+        self.sp_dict[symbol] = {**self.sp_dict.get(symbol, {'detail': ''}), 'next_earnings': next_earnings,
+                                'table': table, 'avg': self.avg_price(table, 10), 'pending_earnings': pending}
+        self.mark_updated(symbol)
+
+    # Roll the n most recent reports forward with the new rows
+    # No table means the earnings page lists nothing after the stored reports, so nothing is pending either
+    def _extend_table(self, symbol, n, table):
+        if symbol not in self.sp_dict:
+            return
+        info = self.sp_dict[symbol]
+        if table is None:
+            if len(info.get('pending_earnings', [])) > 0:
+                info['pending_earnings'] = []
+                self.mark_updated(symbol)
+            return
+        # An empty table is a failed price download, pending reports stay pending
+        if len(table) == 0:
+            return
+        table, pending = self._complete_events(table)
+        changed = pending != info.get('pending_earnings', [])
+        info['pending_earnings'] = pending
+        old_table = info['table']
+        new_rows = arrays.EarningsView.from_frame(table)
+        if len(new_rows) > 0:
+            info['avg'] = self.roll_avg(info['avg'], old_table, new_rows, n)
+            info['table'] = arrays.EarningsView.concat([new_rows, old_table], n)
+        if changed or len(new_rows) > 0:
+            self.mark_updated(symbol)
+
+    # Split a table from bulk_daily_prices, most recent report first, into the reports that can be stored
+    # and the pending date: [date of the oldest report still waiting for prices], or [] if none are
+    # A report waits while it has no close before it or no finished market day after it (today's bar may still be trading)
+    # Everything from the oldest waiting report on is held back, so the stored reports never skip one
+    # and the next refresh picks them all up again from the latest stored date
+    # Reports older than _PENDING_DAYS won't get their prices anymore and are stored as they are
+    def _complete_events(self, table):
+        if len(table) == 0:
+            return table, []
+        dates = pd.to_datetime(table['Date'])
+        post_days = pd.to_datetime(table['Date_Post']).dt.tz_convert(self._EASTERN_TZ).dt.normalize()
+        today = pd.Timestamp.now(tz=self._EASTERN_TZ).normalize()
+        complete = table['Close_Pre'].notna() & table['Close_Post'].notna() & (post_days < today)
+        waiting = ~complete & (dates >= today - pd.Timedelta(days=self._PENDING_DAYS))
+        if not waiting.any():
+            return table, []
+        oldest = dates[waiting].min()
+        return table[dates < oldest].reset_index(drop=True), [oldest]
+
+    def _store_next_earnings(self, symbol, dates):
+        if symbol in self.sp_dict and len(dates) > 0:
+            self.sp_dict[symbol]['next_earnings'] = dates
+            self.mark_updated(symbol)
+
+    def _store_detail(self, symbol, detail, *_):
+        if symbol in self.sp_dict and isinstance(detail, str):
+            self.sp_dict[symbol]['detail'] = detail
+            self.mark_updated(symbol)
+
+    # Remember a changed symbol for saving and tell the listener about it
+    def mark_updated(self, symbol):
+        self._writer.mark(symbol)
+        self._notify(symbol)
+
+    # Write all pending changes to the store now
+    def flush(self):
+        self._writer.flush()
+
+    # Rebuild the earnings reaction statistics of all symbols and store them
+    # implied_moves optionally maps symbol -> absolute percent move implied by options prices
+    def update_stats(self, implied_moves=None):
+        tables = {symbol: self.sp_dict[symbol].get('table') for symbol in self.sp_dict}
+        # The dict object is kept so CompanyInfo sees the new values
+        self.stats.clear()
+        self.stats.update(stats.EarningsStats().compute(tables, implied_moves=implied_moves))
+        self._store.save_stats(self.stats)
+
+    def _notify(self, symbol):
+        if self._on_update:
+            try:
+                self._on_update(symbol)
+            except Exception:
+                pass
 
     # Decorator properties for dict to help with organization of getters and setters
     @property
     def data(self):
         return self.sp_dict
 
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def bars(self):
+        return self._bars
+
     def first_date(self):
         dates = []
         for symbol in self.sp_dict:
             dates.append(self.sp_dict[symbol]['table']['Date'].min())
         return pd.Series(dates).min()
 
-    # Update the earnings dates for companies with earnings dates in the next days
-    # Earnings dates can change within time frame, so it's good to update
-    def update_upcoming_earnings(self, days):
-        update_symbols = []
-        for symbol in self.sp_dict:
-            try:
-                earnings_date = self.sp_dict[symbol].get('next_earnings', [])
-                if len(earnings_date) > 0:
-                    now = datetime.datetime.now(tz=self._EASTERN_TZ)
-                    # appending earnings dates upon program open
-                    if earnings_date[0] < now:
-                        update_symbols.append(symbol)
-                else:
-                    update_symbols.append(symbol)
-            except:
-                continue
-
-        print("\n\nUpdating upcoming earnings:\n\n")
-        # Use Scrape file to get data then store in dict
-        update_next_earnings = scrape.EarningsDates().next_earnings(update_symbols)
-        for symbol in update_next_earnings:
-            if symbol in self.sp_dict:
-                self.sp_dict[symbol]['next_earnings'] = update_next_earnings[symbol]
-
-    # For each date in dates, return the daily price change for the market day before and after date
-    # Daily price change used to calculate averages
-    def daily_prices(self, symbol, dates):
-
-        # Create a data frame with Pandas to easily store data
-        if len(dates) == 0:
-            ret = pd.DataFrame(columns=['Date', 'Open_Pre', 'High_Pre', 'Low_Pre', 'Close_Pre', 'Volume_Pre',
-                                        'Dividends_Pre', 'Stock Splits_Pre', 'Date_Pre', 'Open_Post',
-                                        'High_Post', 'Low_Post', 'Close_Post', 'Volume_Post', 'Dividends_Post',
-                                        'Stock Splits_Post', 'Date_Post', 'Point_Change', 'Percent_Change'])
-            ret.set_index('Date')
-            return ret
-
-        # The yfinance API uses dashes and not dots in tickers
-        symbol = symbol.replace('.', '-')
-        ticker = yf.Ticker(symbol)
-
+    # Earnings tables for many symbols at once: earnings maps symbol -> earnings dates
+    # Price histories for all symbols come from the price source in batches
+    # Symbols whose prices could not be downloaded get an empty table
+    def bulk_daily_prices(self, earnings):
+        windows = {symbol: self._price_window(earnings[symbol]) for symbol in earnings if len(earnings[symbol]) > 0}
+        histories = self._price_source.histories(windows) if len(windows) > 0 else {}
+        for symbol in windows:
+            if symbol not in histories:
+                metrics.shared_metrics().failed(symbol, 'no price history', stage='prices')
+        tables = self.earnings_tables(histories, earnings)
+        for symbol in earnings:
+            if symbol not in tables:
+                tables[symbol] = pd.DataFrame(columns=self._TABLE_COLUMNS)
+        return tables
+
+    # Pulls extra dates in case next market day isn't the next actual day
+    # Next market day may not be until after weekend or holiday
+    # Check ten days out in both directions just to be sure
+    def _price_window(self, dates):
         # Make dates lists using Series as Column in Table
-        if isinstance(dates, list):
-            dates = pd.Series(dates)
-
-        # Pulls extra dates in case next market day isn't the next actual day
-        # Next market day may not be until after weekend or holiday
-        # Check ten days out in both directions just to be sure
+        dates = pd.Series(dates)
         min_date = pd.to_datetime(
             str(dates.min() - datetime.timedelta(days=10))).strftime('%Y-%m-%d')
         max_date = pd.to_datetime(
             str(dates.max() + datetime.timedelta(days=10))).strftime('%Y-%m-%d')
-
-        # Price history from Yahoo Finance
-        price_history = ticker.history(
-            start=min_date, end=max_date, interval="1d")
-        price_history.index = price_history.index.map(
+        return min_date, max_date
+
+    # Match every earnings date of every symbol with the market day before and after it in one pass
+    # histories maps symbol -> daily price history, earnings maps symbol -> earnings dates
+    # Returns symbol -> table with the _TABLE_COLUMNS columns
+    def earnings_tables(self, histories, earnings):
+        symbols = [_ for _ in earnings if _ in histories and len(earnings[_]) > 0]
+        tables = {}
+        if len(symbols) == 0:
+            return tables
+
+        # Stack all bars into one array sorted by (symbol, time)
+        # Each symbol gets its own block of the search key so one searchsorted covers all symbols
+        bar_codes, bar_times, bar_values = [], [], []
+        for code, symbol in enumerate(symbols):
+            history = histories[symbol].reindex(columns=self._BAR_COLUMNS)
             # Ensure price report times are correct
-            lambda date: self._EASTERN_TZ.localize(date.to_pydatetime()))
-
-        # The closest market day boundaries
-        def date_upper_bound(
-                df, date):
-            return df.loc[df.loc[df.index >= date].index.min()]
-
-        def date_lower_bound(df, date):
-            return df.loc[df.loc[df.index < date.replace(
-                hour=0, minute=0)].index.max()]
-
-        # Closest market day before earnings report date
-        # We use this for price change
-        pre_daily = pd.DataFrame(
-            [date_lower_bound(price_history, date) for date in dates])
-        pre_daily['Date'] = pre_daily.index
-        pre_daily = pre_daily.reset_index(drop=True)
-
-        # Closest market day after earnings report date
-        post_daily = pd.DataFrame(
-            [date_upper_bound(price_history, date) for date in dates])
-        post_daily['Date'] = post_daily.index
-        post_daily = post_daily.reset_index(drop=True)
+            index = self._to_eastern(history.index)
+            bar_codes.append(np.full(len(index), code, dtype=np.int64))
+            bar_times.append(index)
+            bar_values.append(history.to_numpy(dtype=np.float64))
+
+        bar_codes = np.concatenate(bar_codes)
+        bar_times = np.concatenate([self._utc_values(_) for _ in bar_times])
+        bar_values = np.concatenate(bar_values)
+        bar_keys = bar_codes * self._SYMBOL_SPAN + bar_times.astype('datetime64[s]').astype(np.int64)
+        order = np.argsort(bar_keys, kind='stable')
+        bar_codes, bar_times, bar_values, bar_keys = \
+            bar_codes[order], self._from_utc_values(bar_times[order]), bar_values[order], bar_keys[order]
+
+        # Flatten the earnings dates the same way, keeping each symbol's own order
+        event_codes, event_dates = [], []
+        for code, symbol in enumerate(symbols):
+            dates = self._to_eastern(pd.DatetimeIndex(pd.Series(earnings[symbol])))
+            event_codes.append(np.full(len(dates), code, dtype=np.int64))
+            event_dates.append(dates)
+        counts = [len(_) for _ in event_codes]
+        event_codes = np.concatenate(event_codes)
+        event_dates = event_dates[0].append(event_dates[1:]) if len(event_dates) > 1 else event_dates[0]
+
+        # Closest market day after earnings report date: first bar at or after the report
+        post_keys = event_codes * self._SYMBOL_SPAN + self._epoch_seconds(event_dates)
+        post = np.searchsorted(bar_keys, post_keys, side='left')
+        post_valid = post < len(bar_keys)
+        post_valid[post_valid] = bar_codes[post[post_valid]] == event_codes[post_valid]
+
+        # Closest market day before earnings report date: last bar before midnight of the report day
+        pre_keys = event_codes * self._SYMBOL_SPAN + self._epoch_seconds(event_dates.normalize())
+        pre = np.searchsorted(bar_keys, pre_keys, side='left') - 1
+        pre_valid = pre >= 0
+        pre_valid[pre_valid] = bar_codes[pre[pre_valid]] == event_codes[pre_valid]
+
+        def take(positions, valid):
+            values = bar_values[np.where(valid, positions, 0)]
+            values[~valid] = np.nan
+            dates = bar_times[np.where(valid, positions, 0)].to_series().reset_index(drop=True)
+            dates[~valid] = pd.NaT
+            return values, dates
+
+        pre_values, pre_dates = take(pre, pre_valid)
+        post_values, post_dates = take(post, post_valid)
 
         # Subtracting the prices at those dates to get price changes
-        daily = pre_daily.join(post_daily, lsuffix="_Pre", rsuffix="_Post")
-        daily = daily.assign(
-                Point_Change=lambda row: (row['Close_Post'] - row['Close_Pre']),
-                Percent_Change=lambda row: ((row['Close_Post'] - row['Close_Pre']) * 100 / row['Close_Pre']))
-        # Show date of earnings
-        daily['Date'] = dates
-        daily.set_index('Date')
-
-        return daily
+        columns = {'Date': event_dates.to_series().reset_index(drop=True)}
+        for suffix, values, dates in (('_Pre', pre_values, pre_dates), ('_Post', post_values, post_dates)):
+            for index, column in enumerate(self._BAR_COLUMNS):
+                columns[column + suffix] = values[:, index]
+            columns['Date' + suffix] = dates
+        close_pre = pre_values[:, self._BAR_COLUMNS.index('Close')]
+        close_post = post_values[:, self._BAR_COLUMNS.index('Close')]
+        columns['Point_Change'] = close_post - close_pre
+        columns['Percent_Change'] = (close_post - close_pre) * 100 / close_pre
+        daily = pd.DataFrame(columns)[self._TABLE_COLUMNS]
+
+        # Split back into one table per symbol
+        start = 0
+        for symbol, count in zip(symbols, counts):
+            table = daily.iloc[start:start + count].reset_index(drop=True)
+            table.set_index('Date')
+            tables[symbol] = table
+            start += count
+        return tables
+
+    # Convert a price or earnings DatetimeIndex to Eastern time
+    def _to_eastern(self, index):
+        if index.tz is None:
+            return index.tz_localize(self._EASTERN_TZ)
+        return index.tz_convert(self._EASTERN_TZ)
+
+    # Timezone aware DatetimeIndex as plain UTC datetime64 values and back
+    def _utc_values(self, index):
+        return index.tz_convert('UTC').tz_localize(None).values.astype('datetime64[ns]')
+
+    def _from_utc_values(self, values):
+        return pd.DatetimeIndex(values).tz_localize('UTC').tz_convert(self._EASTERN_TZ)
+
+    def _epoch_seconds(self, index):
+        return self._utc_values(index).astype('datetime64[s]').astype(np.int64)
 
     # Avg price function used in Earnings Averages function to send to GUI
+    # prices is an earnings table, missing prices are left out like pandas does
     def avg_price(self, prices, n):
-        return {'point_avg': (abs(prices['Point_Change'][:n])).mean(), 'percent_avg': (abs(prices['Percent_Change'][:n])).mean()}
+        return {'point_avg': self._abs_mean(prices['Point_Change'][:n]), 'percent_avg': self._abs_mean(prices['Percent_Change'][:n])}
+
+    def _abs_mean(self, values):
+        values = np.abs(np.asarray(values, dtype=np.float64))
+        values = values[~np.isnan(values)]
+        return values.mean() if len(values) > 0 else float('nan')
+
+    # avg_price over the n most recent events after new_rows are put in front of old_table
+    # Works from the old averages: adds the new events and takes out the ones pushed past n
+    def roll_avg(self, avg, old_table, new_rows, n):
+        added = min(len(new_rows), n)
+        rolled = {}
+        for key, column in (('point_avg', 'Point_Change'), ('percent_avg', 'Percent_Change')):
+            old = np.abs(np.asarray(old_table[column][:n], dtype=np.float64))
+            new = np.abs(np.asarray(new_rows[column][:added], dtype=np.float64))
+            dropped = old[max(n - added, 0):]
+            count = np.count_nonzero(~np.isnan(old))
+            total = avg[key] * count if count > 0 else 0.0
+            total += np.nansum(new) - np.nansum(dropped)
+            count += np.count_nonzero(~np.isnan(new)) - np.count_nonzero(~np.isnan(dropped))
+            rolled[key] = total / count if count > 0 else float('nan')
+        return rolled
 
     # Company details from Market Watch
     def market_watch_company_detail(self, symbol):
         _MARKET_WATCH_URL = 'https://www.marketwatch.com/investing/stock/%s'
         try:
-            content = requests.get(_MARKET_WATCH_URL %
-                                   symbol, timeout=5).content
-        except:
+            content = fetch.shared_fetcher().fetch(_MARKET_WATCH_URL % symbol)
+        except Exception as error:
+            metrics.shared_metrics().failed(symbol, f'error: {error}', stage='details')
             return ''
-        details = BeautifulSoup(content, 'html.parser').find_all(
-            class_='description__text')
-        # If details exist, add to class
-        if len(details) > 0:
-            return details[0].text
-        return ''
+        if content is None:
+            metrics.shared_metrics().failed(symbol, 'no response', stage='details')
+            return ''
+        # The page is parsed in a worker process, this thread only waits for the text
+        return parsing.shared_pool().run(parsing.company_detail, content)
 
 # Company info class used by GUI
 class CompanyInfo(metaclass=scrape.Singleton):
     _EASTERN_TZ = pytz.timezone('US/Eastern')
 
-    def __init__(self):
+    # With lazy=True the last stored snapshot is used as is and
+    # refresh_in_background() brings it up to date without blocking the caller
+    def __init__(self, lazy=False):
         sp = SPData()
+        if not lazy:
+            sp.refresh()
+        self._sp = sp
         self.companies = sp.companies
         self.sp_dict = sp.data
+        self._store = sp.store
+        self.stats = sp.stats
+
+    # Run the SPData refresh on a worker thread
+    # Passed next earnings dates are looked up first since they show on the home table
+    # on_update(symbol) is called from that thread each time a symbol's data changes
+    # and on_done() once the refresh has finished
+    # The returned thread's error is the exception the refresh failed with, None if it didn't
+    def refresh_in_background(self, on_update=None, on_done=None):
+        def run():
+            try:
+                # Looking up the new dates moves them into the future, so the companies
+                # that just reported are collected first for the refresh to add their reports
+                reporters = self._sp.passed_next_earnings()
+                self.refresh_next_earnings(on_update=on_update)
+                self._sp.refresh(on_update, reporters)
+            except Exception as error:
+                thread.error = error
+                raise
+            finally:
+                if on_done:
+                    on_done()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.error = None
+        thread.start()
+        return thread
+
+    # Company name for a symbol in the current company list
+    def company_name(self, symbol):
+        symbol = symbol.upper()
+        for company in self.companies:
+            if company['symbol'] == symbol:
+                return company['name']
+        return ''
 
     # Averages needed for GUI
     def earnings_averages(self, symbol):
@@ -299,50 +545,83 @@ class CompanyInfo(metaclass=scrape.Singleton):
         if symbol in self.sp_dict:
             return self.sp_dict[symbol]['avg']
 
+    # Precomputed statistics over the n most recent reports, see stats.EarningsStats
+    # n is one of stats.EarningsStats.WINDOWS, returns {} if nothing was computed
+    def earnings_stats(self, symbol, n=10):
+        return self.stats.get(symbol.upper(), {}).get(n, {})
+
     # Percent and Price changes per report
     def earnings_change(self, symbol):
         symbol = symbol.upper()
         if symbol in self.sp_dict:
-            return self.sp_dict[symbol]['table'][['Date', 'Close_Pre', 'Close_Post', 'Percent_Change']].values
+            return self.sp_dict[symbol]['table'].rows(('Close_Pre', 'Close_Post', 'Percent_Change'))
 
     # Dates of earnings reports
     def earnings_dates(self, symbol):
         symbol = symbol.upper()
         if symbol in self.sp_dict:
-            return self.sp_dict[symbol]['table']['Date'].values
+            return self.sp_dict[symbol]['table']['Date']
 
     # Date of upcoming earnings report
+    # Looks the date up on Zacks if the stored one has passed
     def next_earnings_date(self, symbol):
+        symbol = symbol.upper()
+        if symbol in self.sp_dict:
+            if symbol in self.stale_next_earnings([symbol]):
+                next_earnings = scrape.EarningsDates().next_earnings_by_symbol(symbol)
+                self._set_next_earnings(symbol, next_earnings)
+            return self.cached_next_earnings_date(symbol)
+
+        # An error in datetime- to update next start
+        return datetime.datetime(year=1970, month=1, day=1)
+
+    # Date of upcoming earnings report from stored data only, never scrapes
+    # A date that has passed or is missing shows as 2050-01-01 until it is looked up again
+    def cached_next_earnings_date(self, symbol):
         symbol = symbol.upper()
         if symbol in self.sp_dict:
             dates = self.sp_dict[symbol]['next_earnings']
-            now = datetime.datetime.now()
             # Make sure that it is after now
-            date_time = now.strftime("%Y-%m-%d")
-            if len(dates) > 0:
-                if date_time >= dates[0].strftime("%Y-%m-%d"):
-                    next_earnings = scrape.EarningsDates().next_earnings_by_symbol(symbol)
-                    self.sp_dict[symbol]['next_earnings'] = next_earnings
-                    if date_time >= next_earnings[0].strftime("%Y-%m-%d"):
-                        return datetime.datetime(year=2050, month=1, day=1)
-                    else:
-                        pickle.dump(self.sp_dict, open('sp_dict.pickle', 'wb'))
-                        return next_earnings[0]
-                elif dates[0].strftime("%Y-%m-%d") > date_time:
-                    return dates[0]
-            else:
-                # Try to get the next_earnings for symbol from pickle file
-                next_earnings = scrape.EarningsDates().next_earnings_by_symbol(symbol)
-                if len(next_earnings) > 0 and (dates[0].strftime("%Y-%m-%d") > date_time):
-                        self.sp_dict[symbol]['next_earnings'] = next_earnings
-                        pickle.dump(self.sp_dict, open('sp_dict.pickle', 'wb'))
-                        return next_earnings[0]
-                else:
-                    return datetime.datetime(year=2050, month=1, day=1)
+            date_time = datetime.datetime.now().strftime("%Y-%m-%d")
+            if len(dates) > 0 and dates[0].strftime("%Y-%m-%d") > date_time:
+                return dates[0]
+            return datetime.datetime(year=2050, month=1, day=1)
 
         # An error in datetime- to update next start
         return datetime.datetime(year=1970, month=1, day=1)
 
+    # Symbols (all companies by default) whose stored next earnings date has passed or is missing
+    def stale_next_earnings(self, symbols=None):
+        symbols = [_['symbol'] for _ in self.companies] if symbols is None else symbols
+        date_time = datetime.datetime.now().strftime("%Y-%m-%d")
+        stale = []
+        for symbol in symbols:
+            if symbol in self.sp_dict:
+                dates = self.sp_dict[symbol]['next_earnings']
+                if len(dates) == 0 or date_time >= dates[0].strftime("%Y-%m-%d"):
+                    stale.append(symbol)
+        return stale
+
+    # Look up all stale next earnings dates in one concurrent batch
+    # on_update(symbol) is called as each symbol's new date arrives
+    def refresh_next_earnings(self, symbols=None, on_update=None):
+        symbols = self.stale_next_earnings() if symbols is None else symbols
+        if len(symbols) == 0:
+            return
+
+        def on_result(symbol, dates):
+            self._set_next_earnings(symbol, dates)
+            if on_update:
+                on_update(symbol)
+
+        print("\n\nLooking up passed next earnings dates:\n\n")
+        scrape.EarningsDates().next_earnings(symbols, on_result=on_result)
+
+    def _set_next_earnings(self, symbol, dates):
+        if len(dates) > 0:
+            self.sp_dict[symbol]['next_earnings'] = dates
+            self._sp.mark_updated(symbol)
+
     # Acquire company details
     def company_detail(self, symbol):
         symbol = symbol.upper()
@@ -359,30 +638,19 @@ class CompanyInfo(metaclass=scrape.Singleton):
             return {'start': min_date, 'end': max_date}
 
     # Price history data function
+    # Served from the shared bar cache, which only downloads the dates it doesn't have yet
     def stock_data(self, symbol, start, end=None):
-        # Yahoo ticker compliance
-        symbol = symbol.replace('.', '-')
-        return yf.Ticker(symbol).history(start=start, end=end)
+        return self._sp.bars.history(symbol.upper(), start, end)
 
 # Class to grab quote data from HTML, current price, etc.
+# Prices are read from the shared quote cache in quotes.py, which batches and refreshes the requests
 class SPPrice:
-    _BASE_URL = "http://quote-feed.zacks.com/?t=%s"
-    # Use request header as best practice
-    _REQUEST_HEADER = {
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.75 "
-                      "Safari/537.36",
-        "X-Requested-With": "XMLHttpRequest"
-    }
+    @staticmethod
+    # Method to get price, see quotes.QuoteService.prices for wait and on_fetched
+    def prices(symbols, wait=True, on_fetched=None):
+        return quotes.shared_service().prices(symbols, wait=wait, on_fetched=on_fetched)
 
     @staticmethod
-    # Method to get price
-    def prices(symbols):
-        try:
-            url = SPPrice._BASE_URL % ",".join(symbols)
-            resp = requests.get(url, timeout=5).content
-            obj = loads(resp)
-            # return most recent price
-            return {k: obj[k].get('last', '') for k in obj}
-        except:
-            pass
-        return {k: '' for k in symbols}
+    # Prices already fetched, '' for the rest
+    def cached_prices(symbols):
+        return quotes.shared_service().cached(symbols)
@@ -0,0 +1,210 @@
+# This Arrays file holds the compact in-memory form of the per-symbol earnings tables
+# All symbols share one set of contiguous NumPy arrays with an offset range per symbol,
+# and each symbol's table is a zero-copy view into them
+# Only the fields CompanyInfo reads are kept: Date, Close_Pre, Close_Post, Percent_Change and Point_Change
+# The arrays can be saved as a snapshot file and memory mapped back, so startup reads no rows at all
+# and a symbol's rows are only paged in when its table is used
+
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# Float fields of every table, Date is kept separately as UTC datetime64[ns]
+FIELDS = ('Close_Pre', 'Close_Post', 'Percent_Change', 'Point_Change')
+
+_EASTERN_TZ = pytz.timezone('US/Eastern')
+
+# Snapshot layout, little endian, every section starts on an 8 byte boundary:
+#   header    magic, version, symbol count, row count, symbol width (padded to _HEADER_SIZE)
+#   symbols   symbol count fixed width ASCII names
+#   starts    symbol count int64, ends: symbol count int64
+#   Date      row count int64 nanoseconds since the epoch, UTC
+#   FIELDS    row count float64 each, in FIELDS order
+_SNAPSHOT_MAGIC = b'SPSNAP01'
+_HEADER = struct.Struct('<8sQQQQ')
+_HEADER_SIZE = 64
+
+
+# One symbol's earnings table, most recent report first
+# Indexing by field name gives the column: table['Percent_Change'] is a float array,
+# table['Date'] is a DatetimeIndex in Eastern time
+class EarningsView:
+    def __init__(self, dates, columns):
+        self._dates = dates
+        self._columns = columns
+
+    # Table with its own arrays from a DataFrame with at least Date and FIELDS columns
+    @classmethod
+    def from_frame(cls, frame):
+        dates = pd.DatetimeIndex(pd.Series(frame['Date'], dtype=object))
+        if dates.tz is None:
+            dates = dates.tz_localize(_EASTERN_TZ)
+        columns = {field: pd.to_numeric(frame[field], errors='coerce').to_numpy(dtype=np.float64)
+                   for field in FIELDS}
+        return cls(_utc_values(dates), columns)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype='datetime64[ns]'), {field: np.empty(0) for field in FIELDS})
+
+    # Tables stacked in order into one table with its own arrays, cut to the first n rows
+    @classmethod
+    def concat(cls, tables, n=None):
+        dates = np.concatenate([_._dates for _ in tables])[:n]
+        columns = {field: np.concatenate([_._columns[field] for _ in tables])[:n] for field in FIELDS}
+        return cls(dates, columns)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def __getitem__(self, field):
+        if field == 'Date':
+            return pd.DatetimeIndex(self._dates).tz_localize('UTC').tz_convert(_EASTERN_TZ)
+        return self._columns[field]
+
+    # First n rows, sharing this table's arrays
+    def head(self, n):
+        return EarningsView(self._dates[:n], {field: self._columns[field][:n] for field in FIELDS})
+
+    # Rows as tuples of (date, *fields) for display
+    def rows(self, fields=FIELDS):
+        return list(zip(self['Date'], *[self._columns[_] for _ in fields]))
+
+    def latest_date(self):
+        return self['Date'].max() if len(self) > 0 else None
+
+    def frame(self):
+        return pd.DataFrame({'Date': self['Date'], **self._columns})
+
+    @property
+    def nbytes(self):
+        return self._dates.nbytes + sum(_.nbytes for _ in self._columns.values())
+
+
+# Earnings tables of all symbols in contiguous arrays
+# Rows of a symbol sit in [starts[i], ends[i]) of every array
+class EarningsArrays:
+    def __init__(self, symbols, starts, ends, dates, columns):
+        self.symbols = list(symbols)
+        self._index = {symbol: position for position, symbol in enumerate(self.symbols)}
+        self._starts = starts
+        self._ends = ends
+        self._dates = dates
+        self._columns = columns
+
+    # Build from rows grouped by symbol, each row (symbol, iso date, *FIELDS)
+    @classmethod
+    def from_rows(cls, rows):
+        symbols = [_[0] for _ in rows]
+        # Rows are grouped by symbol, so each symbol's range starts where its name first appears
+        boundaries = [0] + [_ for _ in range(1, len(symbols)) if symbols[_] != symbols[_ - 1]] + [len(symbols)]
+        dates = _utc_values(pd.to_datetime([_[1] for _ in rows], utc=True)) if len(rows) > 0 \
+            else np.empty(0, dtype='datetime64[ns]')
+        values = np.array([_[2:] for _ in rows], dtype=np.float64).reshape(len(rows), len(FIELDS))
+        columns = {field: np.ascontiguousarray(values[:, index]) for index, field in enumerate(FIELDS)}
+        return cls([symbols[_] for _ in boundaries[:-1]] if len(rows) > 0 else [],
+                   np.array(boundaries[:-1], dtype=np.int64), np.array(boundaries[1:], dtype=np.int64),
+                   dates, columns)
+
+    # Build from {symbol: EarningsView}, copying every table into the shared arrays
+    @classmethod
+    def from_tables(cls, tables):
+        symbols = [_ for _ in sorted(tables) if tables[_] is not None and len(tables[_]) > 0]
+        lengths = np.array([len(tables[_]) for _ in symbols], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        if len(symbols) == 0:
+            return cls([], lengths, ends, np.empty(0, dtype='datetime64[ns]'), {field: np.empty(0) for field in FIELDS})
+        dates = np.concatenate([tables[_]._dates for _ in symbols]).astype('datetime64[ns]')
+        columns = {field: np.concatenate([tables[_]._columns[field] for _ in symbols]).astype(np.float64)
+                   for field in FIELDS}
+        return cls(symbols, ends - lengths, ends, dates, columns)
+
+    # Arrays memory mapped from a snapshot file written by write_snapshot
+    # Only the header and symbol index are read here, rows are paged in by the OS as views touch them
+    @classmethod
+    def open_snapshot(cls, path):
+        header = read_snapshot_header(path)
+        if header is None:
+            raise ValueError("%s is not an earnings snapshot" % path)
+        version, symbol_count, row_count, width = header
+
+        offset = _HEADER_SIZE
+
+        def section(dtype, count):
+            nonlocal offset
+            if count == 0:
+                return np.empty(0, dtype=dtype)
+            values = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+            offset += values.nbytes
+            return values
+
+        names = section('S%d' % width, symbol_count)
+        # Keep the section offsets 8 byte aligned after the names
+        offset += -offset % 8
+        starts = section('<i8', symbol_count)
+        ends = section('<i8', symbol_count)
+        dates = section('<M8[ns]', row_count)
+        columns = {field: section('<f8', row_count) for field in FIELDS}
+        snapshot = cls([_.decode('ascii') for _ in names], starts, ends, dates, columns)
+        snapshot.version = version
+        return snapshot
+
+    # Save in the snapshot layout, written to a temporary file and renamed so readers never see half a file
+    # version is stored in the header so the reader can tell if the snapshot is out of date
+    def write_snapshot(self, path, version):
+        names = np.array([_.encode('ascii') for _ in self.symbols], dtype=bytes)
+        width = max(names.dtype.itemsize, 1)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as snapshot:
+                snapshot.write(_HEADER.pack(
+                    _SNAPSHOT_MAGIC, version, len(self.symbols), len(self._dates), width).ljust(_HEADER_SIZE, b'\0'))
+                snapshot.write(names.astype('S%d' % width).tobytes())
+                snapshot.write(b'\0' * (-(len(names) * width) % 8))
+                for values, dtype in ((self._starts, '<i8'), (self._ends, '<i8'), (self._dates, '<M8[ns]'),
+                                      *[(self._columns[_], '<f8') for _ in FIELDS]):
+                    snapshot.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def __contains__(self, symbol):
+        return symbol in self._index
+
+    # Zero-copy table of one symbol, empty if the symbol has no rows
+    def view(self, symbol):
+        if symbol not in self._index:
+            return EarningsView.empty()
+        position = self._index[symbol]
+        rows = slice(self._starts[position], self._ends[position])
+        return EarningsView(self._dates[rows], {field: self._columns[field][rows] for field in FIELDS})
+
+    @property
+    def nbytes(self):
+        return (self._dates.nbytes + self._starts.nbytes + self._ends.nbytes
+                + sum(_.nbytes for _ in self._columns.values()))
+
+
+# (version, symbol count, row count, symbol width) of a snapshot file, None if it is missing or not a snapshot
+def read_snapshot_header(path):
+    try:
+        with open(path, 'rb') as snapshot:
+            header = snapshot.read(_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(header) < _HEADER_SIZE:
+        return None
+    magic, *values = _HEADER.unpack_from(header)
+    if magic != _SNAPSHOT_MAGIC:
+        return None
+    return tuple(values)
+
+
+# Timezone aware DatetimeIndex as plain UTC datetime64[ns] values
+def _utc_values(index):
+    return index.tz_convert('UTC').tz_localize(None).values.astype('datetime64[ns]')
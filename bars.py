@@ -0,0 +1,184 @@
+# This Bars file keeps daily OHLCV price bars on disk for api.py
+# Earnings tables, company charts and anything else that needs price history read through one cache,
+# which remembers the date ranges it has already downloaded per symbol, merges overlapping ranges
+# and only asks the price source for the gaps
+
+import datetime
+import sqlite3
+import threading
+
+import pandas as pd
+import pytz
+
+import metrics
+
+
+# Per symbol daily bar cache in front of a price source (anything with a histories(windows) method)
+# It has the same histories(windows) method, so it can stand in wherever a price source is used
+class BarCache:
+    _EASTERN_TZ = pytz.timezone('US/Eastern')
+    _COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+    # Seconds the bars of the current, unfinished market day are reused before downloading them again
+    _LIVE_TTL = 60 * 60
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bars (
+            symbol TEXT NOT NULL,
+            date TEXT NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            dividends REAL,
+            splits REAL,
+            PRIMARY KEY (symbol, date)
+        );
+        CREATE TABLE IF NOT EXISTS bar_ranges (
+            symbol TEXT NOT NULL,
+            start TEXT NOT NULL,
+            end TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bar_ranges_symbol ON bar_ranges (symbol);
+        CREATE TABLE IF NOT EXISTS bar_live (
+            symbol TEXT PRIMARY KEY,
+            fetched_at TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, source, path='price_bars.db'):
+        self._source = source
+        self._lock = threading.Lock()
+        # Price sources such as yfinance aren't safe to call from several threads at once,
+        # and the refresh, GUI charts and service may all ask for bars together
+        self._source_lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(self._SCHEMA)
+
+    # Daily bars of one symbol from start up to (not including) end, today if end is None
+    # DataFrame indexed by date like yfinance's history()
+    def history(self, symbol, start, end=None):
+        return self.histories({symbol: (str(start)[:10], end)}).get(symbol, self._frame([]))
+
+    # windows maps symbol -> (start, end) date strings, end may be None for up to today
+    # Returns symbol -> bars for every symbol that has any in its window
+    def histories(self, windows):
+        today = self._today()
+        tomorrow = (datetime.date.fromisoformat(today) + datetime.timedelta(days=1)).isoformat()
+        windows = {symbol: (start, min(end or tomorrow, tomorrow)) for symbol, (start, end) in windows.items()}
+        self._fill_gaps(windows, today)
+
+        histories = {}
+        with self._lock:
+            for symbol, (start, end) in windows.items():
+                rows = self._db.execute(
+                    "SELECT date, open, high, low, close, volume, dividends, splits FROM bars "
+                    "WHERE symbol = ? AND date >= ? AND date < ? ORDER BY date", (symbol, start, end)).fetchall()
+                if len(rows) > 0:
+                    histories[symbol] = self._frame(rows)
+        return histories
+
+    # Download every part of the windows not in the cache yet
+    # The source takes one window per symbol, so symbols with several gaps take several rounds
+    def _fill_gaps(self, windows, today):
+        tried = set()
+        while True:
+            gaps = self._next_gaps(windows, today, tried)
+            if len(tried) == 0:
+                # Windows served entirely from the database count as hits
+                metrics.shared_metrics().cache('bars', 'miss', len(gaps))
+                metrics.shared_metrics().cache('bars', 'hit', len(windows) - len(gaps))
+            if len(gaps) == 0:
+                return
+            # One download at a time, the gaps are looked up again once it is this thread's turn
+            # since the download before may have filled them
+            with self._source_lock:
+                gaps = self._next_gaps(windows, today, tried)
+                if len(gaps) == 0:
+                    return
+                tried.update(gaps.items())
+                histories = self._source.histories(gaps)
+                with self._lock, self._db:
+                    for symbol, history in histories.items():
+                        self._store(symbol, gaps[symbol], history, today)
+
+    # First gap of each symbol's window that hasn't been tried yet
+    def _next_gaps(self, windows, today, tried):
+        with self._lock:
+            gaps = {}
+            for symbol, (start, end) in windows.items():
+                for gap in self._gaps(symbol, start, end, today):
+                    if (symbol, gap) not in tried:
+                        gaps[symbol] = gap
+                        break
+            return gaps
+
+    # Parts of [start, end) not covered by stored ranges
+    # Bars from today on are only covered for _LIVE_TTL seconds after they were downloaded
+    def _gaps(self, symbol, start, end, today):
+        ranges = self._db.execute(
+            "SELECT start, end FROM bar_ranges WHERE symbol = ? AND end > ? AND start < ? ORDER BY start",
+            (symbol, start, end)).fetchall()
+        live = self._db.execute("SELECT fetched_at FROM bar_live WHERE symbol = ?", (symbol,)).fetchone()
+        if live is not None and self._age(live[0]) < self._LIVE_TTL:
+            ranges.append((today, end))
+            ranges.sort()
+
+        gaps = []
+        position = start
+        for range_start, range_end in ranges:
+            if range_start > position:
+                gaps.append((position, min(range_start, end)))
+            position = max(position, range_end)
+            if position >= end:
+                break
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def _store(self, symbol, window, history, today):
+        start, end = window
+        history = history.reindex(columns=self._COLUMNS)
+        rows = [(symbol, str(date)[:10], *[None if _ != _ else float(_) for _ in values])
+                for date, values in zip(history.index, history.itertuples(index=False, name=None))]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO bars (symbol, date, open, high, low, close, volume, dividends, splits) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        # Prices are split adjusted, so a new split makes every older stored bar wrong
+        splits = history['Stock Splits'].fillna(0)
+        if (splits != 0).any():
+            self._db.execute("DELETE FROM bars WHERE symbol = ? AND date < ?", (symbol, start))
+            self._db.execute("DELETE FROM bar_ranges WHERE symbol = ?", (symbol,))
+
+        # The current market day can still change, only the days before it are covered for good
+        if end > today:
+            self._db.execute(
+                "INSERT OR REPLACE INTO bar_live (symbol, fetched_at) VALUES (?, ?)",
+                (symbol, datetime.datetime.now(tz=self._EASTERN_TZ).isoformat()))
+        self._add_range(symbol, start, min(end, today))
+
+    # Add a covered range and merge it with the ranges it overlaps or touches
+    def _add_range(self, symbol, start, end):
+        if start >= end:
+            return
+        ranges = self._db.execute(
+            "SELECT start, end FROM bar_ranges WHERE symbol = ? AND end >= ? AND start <= ?",
+            (symbol, start, end)).fetchall()
+        for range_start, range_end in ranges:
+            start = min(start, range_start)
+            end = max(end, range_end)
+        self._db.execute(
+            "DELETE FROM bar_ranges WHERE symbol = ? AND end >= ? AND start <= ?", (symbol, start, end))
+        self._db.execute("INSERT INTO bar_ranges (symbol, start, end) VALUES (?, ?, ?)", (symbol, start, end))
+
+    def _frame(self, rows):
+        frame = pd.DataFrame([_[1:] for _ in rows], columns=self._COLUMNS, dtype=float)
+        frame.index = pd.DatetimeIndex([_[0] for _ in rows], name='Date')
+        return frame
+
+    def _today(self):
+        return datetime.datetime.now(tz=self._EASTERN_TZ).strftime('%Y-%m-%d')
+
+    def _age(self, timestamp):
+        return (datetime.datetime.now(tz=self._EASTERN_TZ) - datetime.datetime.fromisoformat(timestamp)).total_seconds()
@@ -0,0 +1,159 @@
+# This Benchmark file times the CPU-bound parts of the scrapers on saved pages
+# Save sample pages once, then benchmark parsing without any network:
+#     python benchmark.py save AAPL MSFT TSLA
+#     python benchmark.py earnings bench_pages/*-earnings.html
+#     python benchmark.py dates bench_pages/*-earnings.html
+#     python benchmark.py pool bench_pages/*-earnings.html --processes 4
+
+import argparse
+import os
+import time
+from os.path import join
+
+from dateutil import parser
+
+import parsing
+import scrape
+
+_PAGES_DIR = 'bench_pages'
+
+
+# Download the Zacks earnings announcements page of each symbol into bench_pages
+def save_pages(symbols):
+    os.makedirs(_PAGES_DIR, exist_ok=True)
+    earnings_dates = scrape.EarningsDates()
+    for symbol in symbols:
+        content = earnings_dates._fetcher.fetch(earnings_dates._EARNINGS_URL % symbol.upper())
+        if content is None:
+            print(f"{symbol}: download failed")
+            continue
+        filename = join(_PAGES_DIR, f"{symbol.upper()}-earnings.html")
+        with open(filename, 'wb') as page:
+            page.write(content)
+        print(f"{symbol}: saved {filename}")
+
+
+# Best of `repeat` runs of func over every page, in milliseconds per page
+def _time_per_page(func, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            func(page)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(pages)
+
+
+# Compare the byte search extraction of the earnings table with the BeautifulSoup DOM path
+def bench_earnings(filenames, repeat):
+    pages = []
+    for filename in filenames:
+        with open(filename, 'rb') as page:
+            pages.append(page.read())
+    if len(pages) == 0:
+        print("No pages given")
+        return
+
+    # Both paths have to agree before their timings mean anything
+    for filename, page in zip(filenames, pages):
+        if parsing.earnings_table_fast(page) != parsing.earnings_table_dom(page):
+            print(f"{filename}: fast path and DOM parser disagree")
+
+    fast = _time_per_page(parsing.earnings_table_fast, pages, repeat)
+    dom = _time_per_page(parsing.earnings_table_dom, pages, repeat)
+    print(f"{len(pages)} pages, best of {repeat}")
+    print(f"byte search: {fast:8.3f} ms/page")
+    print(f"DOM parser:  {dom:8.3f} ms/page")
+    print(f"speedup:     {dom / fast:8.1f}x")
+
+
+# Compare DateParser with fuzzy parsing every row, on the date column of each saved page
+def bench_dates(filenames, repeat):
+    columns = []
+    for filename in filenames:
+        with open(filename, 'rb') as page:
+            table = parsing.earnings_table(page.read())
+        if table:
+            columns.append([_[0] for _ in table])
+    if len(columns) == 0:
+        print("No earnings tables found in the given pages")
+        return
+
+    timezone = parsing.EASTERN_TZ
+
+    def fuzzy(column):
+        return [timezone.localize(parser.parse(_, fuzzy=True)) for _ in column]
+
+    # A fresh parser per run so the memo only helps within a run, like a first full rebuild
+    def detected(column, date_parser=None):
+        return (date_parser or parsing.DateParser(timezone)).parse_all(column)
+
+    shared_parser = parsing.DateParser(timezone)
+    rows = sum(len(_) for _ in columns)
+    print(f"{len(columns)} tables, {rows} rows, best of {repeat}")
+    print(f"fuzzy parser:     {_time_per_page(fuzzy, columns, repeat):8.3f} ms/table")
+    print(f"DateParser:       {_time_per_page(detected, columns, repeat):8.3f} ms/table")
+    print(f"DateParser, warm: {_time_per_page(lambda _: detected(_, shared_parser), columns, repeat):8.3f} ms/table")
+
+
+# Compare parsing every page on this thread with the process pool scrape.py uses
+def bench_pool(filenames, processes, copies):
+    pages = []
+    for filename in filenames:
+        with open(filename, 'rb') as page:
+            pages.append(page.read())
+    # Repeat the pages to get close to a full rebuild of every symbol
+    pages = pages * copies
+    if len(pages) == 0:
+        print("No pages given")
+        return
+
+    start = time.perf_counter()
+    serial = [parsing.earnings_times(_) for _ in pages]
+    serial_time = time.perf_counter() - start
+
+    pool = parsing.ParsePool(processes)
+    # Start the workers before timing, the refresh pays for that once per run
+    pool.run(parsing.earnings_times, pages[0])
+    start = time.perf_counter()
+    pooled = [_.result() for _ in [pool.submit(parsing.earnings_times, page) for page in pages]]
+    pool_time = time.perf_counter() - start
+
+    if pooled != serial:
+        print("Pool and serial parsing disagree")
+    print(f"{len(pages)} pages, {processes} processes")
+    print(f"serial: {serial_time:8.3f} s")
+    print(f"pool:   {pool_time:8.3f} s")
+    print(f"speedup:{serial_time / pool_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark scraper parsing on saved pages")
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    save = commands.add_parser('save', help="download sample pages into bench_pages")
+    save.add_argument('symbols', nargs='+')
+
+    earnings = commands.add_parser('earnings', help="time earnings table extraction")
+    earnings.add_argument('pages', nargs='+')
+    earnings.add_argument('--repeat', type=int, default=5)
+
+    dates = commands.add_parser('dates', help="time earnings date parsing")
+    dates.add_argument('pages', nargs='+')
+    dates.add_argument('--repeat', type=int, default=5)
+
+    pool = commands.add_parser('pool', help="time parsing pages in the process pool")
+    pool.add_argument('pages', nargs='+')
+    pool.add_argument('--processes', type=int, default=os.cpu_count())
+    pool.add_argument('--copies', type=int, default=1, help="parse each page this many times")
+
+    args = arg_parser.parse_args()
+    if args.command == 'save':
+        save_pages(args.symbols)
+    elif args.command == 'earnings':
+        bench_earnings(args.pages, args.repeat)
+    elif args.command == 'dates':
+        bench_dates(args.pages, args.repeat)
+    elif args.command == 'pool':
+        bench_pool(args.pages, args.processes, args.copies)
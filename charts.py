@@ -0,0 +1,112 @@
+# This Charts file draws the price charts of the company pages in gui.py
+# Long histories are drawn at screen resolution: daily bars are merged into weekly or monthly OHLC bars
+# until they fit the width of the chart, and zooming in draws the visible dates again at full resolution
+# Earnings markers are placed with index lookups instead of comparing date strings
+
+import matplotlib.dates as mdates
+import mplfinance as mpf
+import numpy as np
+import pandas as pd
+
+
+# Price chart of one symbol with a marker at each earnings date
+# Draws on a given matplotlib axes, so it works on Tk canvases and off-screen Agg figures alike
+class EarningsChart:
+    # Bar sizes tried in order until a date range fits in max_points bars, None is daily
+    _RESOLUTIONS = (None, 'W-FRI', 'M')
+    _AGGREGATION = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+    # bars is a daily OHLCV DataFrame, dates the earnings dates to mark
+    # max_points is about the width of the chart in pixels
+    def __init__(self, bars, dates, max_points=800):
+        bars = bars[list(self._AGGREGATION)].copy()
+        bars.index = _naive(pd.DatetimeIndex(bars.index))
+        self.bars = bars
+        self.dates = _to_days(dates)
+        self.max_points = max_points
+        # Bar size and date range of what is on the axes now, None for an open end
+        self.resolution = None
+        self._drawn = (None, None)
+
+    # Draw the bars between start and end (whole history by default)
+    # The bar size is picked so the dates between fit_start and fit_end fit, start to end by default
+    def draw(self, ax, start=None, end=None, fit_start=None, fit_end=None):
+        rule = self._rule(fit_start or start, fit_end or end)
+        bars = self._resample(self.bars.loc[start:end], rule)
+        # clear() gives the axes a new callback registry, the zoom handler connected to the old one is kept
+        callbacks = ax.callbacks
+        ax.clear()
+        ax.callbacks = callbacks
+        self.resolution = rule
+        self._drawn = (
+            None if start is None or len(self.bars) == 0 or start <= self.bars.index[0] else start,
+            None if end is None or len(self.bars) == 0 or end >= self.bars.index[-1] else end,
+        )
+        if len(bars) == 0:
+            return
+
+        addplot = []
+        markers = self._markers(bars, rule is None, start, end)
+        if not np.isnan(markers).all():
+            addplot.append(mpf.make_addplot(markers, type='scatter', marker='^', markersize=200, ax=ax))
+        mpf.plot(bars, type='line', ax=ax, addplot=addplot, show_nontrading=True)
+
+    # True when the dates now visible on ax need another bar size or go past what was drawn
+    def needs_redraw(self, ax):
+        start, end = self._visible(ax)
+        return (self._rule(start, end) != self.resolution
+                or (self._drawn[0] is not None and start < self._drawn[0])
+                or (self._drawn[1] is not None and end > self._drawn[1]))
+
+    # Redraw the visible dates at the bar size that fits them, keeping the view where it is
+    def draw_view(self, ax):
+        low, high = ax.get_xlim()
+        start, end = self._visible(ax)
+        span = end - start
+        # A margin on each side so a short pan needs no redraw
+        self.draw(ax, start - span, end + span, start, end)
+        ax.set_xlim(low, high)
+
+    def _visible(self, ax):
+        return tuple(pd.Timestamp(mdates.num2date(_)).tz_localize(None) for _ in ax.get_xlim())
+
+    # Finest bar size with at most max_points bars between start and end
+    def _rule(self, start, end):
+        bars = self.bars.loc[start:end]
+        for rule in self._RESOLUTIONS:
+            count = len(bars) if rule is None else len(bars.index.to_period(rule).unique())
+            if count <= self.max_points:
+                return rule
+        return self._RESOLUTIONS[-1]
+
+    # OHLCV bars merged per period, labelled with the last trading day in each period
+    def _resample(self, bars, rule):
+        if rule is None or len(bars) == 0:
+            return bars
+        periods = bars.index.to_period(rule)
+        resampled = bars.groupby(periods).agg(self._AGGREGATION)
+        resampled.index = pd.DatetimeIndex(pd.Series(bars.index, index=bars.index).groupby(periods).last().values)
+        return resampled.dropna(subset=['Close'])
+
+    # Marker values (95% of the open, NaN elsewhere) aligned with bars
+    # Daily bars only mark exact dates, merged bars mark the period each date falls in
+    def _markers(self, bars, exact, start, end):
+        dates = self.dates[(self.dates >= (start or bars.index[0])) & (self.dates <= (end or bars.index[-1]))]
+        positions = bars.index.searchsorted(dates, side='left')
+        inside = positions < len(bars)
+        positions, dates = positions[inside], dates[inside]
+        if exact:
+            positions = positions[bars.index[positions] == dates]
+        markers = np.full(len(bars), np.nan)
+        markers[positions] = bars['Open'].to_numpy()[positions] * 0.95
+        return markers
+
+
+# Earnings dates as sorted midnight timestamps without timezone, the same calendar day they show in
+def _to_days(dates):
+    return _naive(pd.DatetimeIndex(dates)).normalize().unique().sort_values()
+
+
+# Local wall clock times without the timezone
+def _naive(index):
+    return index.tz_localize(None) if index.tz is not None else index
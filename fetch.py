@@ -0,0 +1,418 @@
+# This Fetch file holds the asyncio HTTP engine used by the scrapers
+# Pages are downloaded over one shared keep-alive connection pool with a limit on requests in flight
+# Every host gets a token bucket whose rate adapts to 429s and response times, failed requests are retried
+# with jittered exponential backoff, and a host that keeps failing is skipped for a while by a circuit breaker
+# Responses go through the on-disk HTTP cache in httpcache.py
+
+import asyncio
+import datetime
+import random
+import threading
+import time
+from concurrent.futures import as_completed, TimeoutError
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import httpcache
+import metrics
+
+
+# Token bucket for one host whose rate follows how the host responds (additive increase, multiplicative decrease):
+# the rate grows by about INCREASE requests per second every second while responses come back quickly,
+# and is cut when the host answers 429 or its response times climb
+# Thread safe, so fetchers running on different event loops share the bucket of a host
+class AdaptiveTokenBucket:
+    INCREASE = 1.0
+    # Rate kept after a 429, and after responses got slow
+    THROTTLED_FACTOR = 0.5
+    SLOW_FACTOR = 0.8
+    # Seconds between two cuts, the requests already in flight when the rate was cut answer the same way
+    DECREASE_INTERVAL = 1.0
+    # Responses are slow once the average latency is this many times its lowest value, and at least LATENCY_FLOOR
+    SLOW_RATIO = 2.0
+    LATENCY_FLOOR = 0.5
+
+    def __init__(self, rate, max_rate=None, min_rate=0.5):
+        self.rate = float(rate)
+        self._max_rate = float(max_rate or rate * 4)
+        self._min_rate = min(float(min_rate), self.rate)
+        # Up to a second of requests can start at once, tokens below zero are requests already waiting
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        # Moving average of response times and its lowest value so far
+        self._latency = None
+        self._best_latency = None
+        self._lock = threading.Lock()
+
+    # Seconds the caller has to wait before sending one request, the request is counted now
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            return max(wait, self._paused_until - now)
+
+    # A response came back after seconds
+    def success(self, seconds):
+        with self._lock:
+            self._latency = seconds if self._latency is None else 0.8 * self._latency + 0.2 * seconds
+            self._best_latency = self._latency if self._best_latency is None else min(self._best_latency, self._latency)
+            if self._latency > max(self.LATENCY_FLOOR, self.SLOW_RATIO * self._best_latency):
+                self._decrease(self.SLOW_FACTOR)
+            else:
+                self.rate = min(self._max_rate, self.rate + self.INCREASE / self.rate)
+
+    # The host answered 429 (or 503), nothing is sent to it for pause seconds
+    def throttled(self, pause=0.0):
+        with self._lock:
+            self._decrease(self.THROTTLED_FACTOR)
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self._last_decrease < self.DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        self.rate = max(self._min_rate, self.rate * factor)
+        # Requests already waiting keep their place, no new burst is allowed
+        self._tokens = min(self._tokens, 0.0)
+
+
+# Stops requests to a host after THRESHOLD failures in a row
+# After COOLDOWN seconds one trial request is let through: success closes the breaker, failure opens it again
+# Requests that can wait use wait() to be sent once the host is back instead of failing
+class CircuitBreaker:
+    THRESHOLD = 5
+    COOLDOWN = 30.0
+    # Seconds between looks at the breaker while another request's trial decides whether it closes
+    POLL = 1.0
+
+    def __init__(self):
+        self._failures = 0
+        self._opened_at = None
+        # Start of the trial request while half open
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened_at is not None
+
+    # True if a request may be sent now
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.COOLDOWN:
+                return False
+            # A trial that never reported back, for example a cancelled request, doesn't block the host for good
+            if self._trial_at is not None and now - self._trial_at < self.COOLDOWN:
+                return False
+            self._trial_at = now
+            return True
+
+    # Seconds to wait before asking allow() again, None if the host won't take a request
+    # before give_up (a time.monotonic() value) because the cooldown lasts longer or give_up has passed
+    def wait_time(self, give_up):
+        with self._lock:
+            now = time.monotonic()
+            if now >= give_up:
+                return None
+            if self._opened_at is None:
+                return 0.0
+            cooldown = self._opened_at + self.COOLDOWN - now
+            if cooldown > 0:
+                return cooldown if now + cooldown < give_up else None
+            # Cooled down, another request is the trial
+            return min(self.POLL, give_up - now)
+
+    # Block until a request may be sent, which may be the trial, False if that won't be before give_up
+    def wait(self, give_up):
+        while not self.allow():
+            pause = self.wait_time(give_up)
+            if pause is None:
+                return False
+            time.sleep(pause)
+        return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_at is not None or self._failures >= self.THRESHOLD:
+                self._opened_at = time.monotonic()
+                self._trial_at = None
+
+
+# Token bucket and circuit breaker of a host
+class HostPolicy:
+    def __init__(self, rate, max_rate=None):
+        self.bucket = AdaptiveTokenBucket(rate, max_rate)
+        self.breaker = CircuitBreaker()
+
+
+# Host policies shared by every fetcher, so all requests to a host count against the same limits
+class HostPolicies:
+    # Starting requests per second of hosts that were not given a rate
+    DEFAULT_RATE = 50
+
+    def __init__(self):
+        self._policies = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        with self._lock:
+            if host not in self._policies:
+                self._policies[host] = HostPolicy(self.DEFAULT_RATE)
+            return self._policies[host]
+
+    # Starting rate for a host, the bucket may go up to four times that while the host keeps up
+    # Hosts already in use keep their learned rate
+    def configure(self, host, rate):
+        with self._lock:
+            if host not in self._policies:
+                self._policies[host] = HostPolicy(rate)
+
+
+_shared_policies = HostPolicies()
+
+
+# Limits per host for requests made outside AsyncFetcher, such as the yfinance downloads
+def shared_policies():
+    return _shared_policies
+
+
+# Seconds to wait before retry number attempt + 1: exponential backoff with jitter,
+# so requests that failed together don't all come back together
+def backoff(attempt, base=0.5, cap=30.0):
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+# asyncio HTTP engine with a shared aiohttp session running on its own event loop thread
+# Callers on normal threads use fetch(), submit() or fetch_all() and never see the event loop
+class AsyncFetcher:
+    # Starting requests per second per host when none are given
+    _DEFAULT_RATE_LIMITS = {'www.zacks.com': 20}
+    # Extra attempts after a failed request, and the backoff before them: BACKOFF * 2 ** attempt seconds
+    # with random jitter, at most MAX_BACKOFF
+    RETRIES = 3
+    BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+    # Longest Retry-After honored, in seconds
+    MAX_RETRY_AFTER = 120.0
+    # Responses worth another try, anything else (404, 403) is final
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    # cache is an httpcache.HTTPCache, the shared one by default, or False for no caching
+    # timeout bounds one request, deadline bounds a page including its retries and waits for the host's bucket
+    def __init__(self, concurrency=100, rate_limits=None, headers=None, timeout=30, connect_timeout=5, cache=None,
+                 deadline=90, policies=None):
+        self._concurrency = concurrency
+        self._cache = httpcache.shared_cache() if cache is None else cache
+        self._policies = policies or _shared_policies
+        for host, rate in (self._DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits).items():
+            self._policies.configure(host, rate)
+        self._headers = headers or {}
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._deadline = deadline
+        self._metrics = metrics.shared_metrics()
+
+        # Event loop, session and semaphore are created on first use
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, args=(loop,), daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+                self._loop = loop
+        return self._loop
+
+    def _run_loop(self, loop):
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    async def _open(self):
+        # HTTP/1.1 keep-alive connections are reused across every request made by this fetcher
+        connector = aiohttp.TCPConnector(limit=self._concurrency, keepalive_timeout=30)
+        self._session = aiohttp.ClientSession(connector=connector, headers=self._headers, timeout=self._timeout)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+
+    # Close the session and stop the event loop thread, the next request starts them again
+    def close(self):
+        with self._start_lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    # Page body as bytes, or None if the request failed
+    async def get(self, url, headers=None):
+        cached = None
+        cacheable = self._cache and self._cache.cacheable(url)
+        if cacheable:
+            cached = self._cache.lookup(url)
+            # Still within its time to live: no request at all
+            if cached is not None and cached['fresh']:
+                self._metrics.cache('http', 'hit')
+                return cached['body']
+            if cached is not None:
+                headers = {**(headers or {}), **self._cache.conditional_headers(cached)}
+
+        host = urlsplit(url).hostname
+        policy = self._policies.get(host)
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + self._deadline
+        for attempt in range(1 + self.RETRIES):
+            wait = policy.bucket.reserve()
+            if loop.time() + wait >= give_up:
+                break
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not await self._wait_for_breaker(host, policy.breaker, give_up):
+                self._metrics.host_event(host, 'circuit_open')
+                break
+
+            status, body, response_headers, error, seconds = await self._request(url, headers, give_up - loop.time())
+            self._metrics.request(host, seconds, status=status, size=len(body or b''), error=error)
+            self._metrics.host_rate(host, policy.bucket.rate)
+
+            # Unchanged since it was cached
+            if status == 304 and cached is not None:
+                policy.bucket.success(seconds)
+                policy.breaker.success()
+                self._metrics.cache('http', 'revalidated')
+                self._cache.revalidated(url, response_headers)
+                return cached['body']
+            if status == 200:
+                policy.bucket.success(seconds)
+                policy.breaker.success()
+                if cacheable:
+                    self._metrics.cache('http', 'miss')
+                    self._cache.store(url, response_headers, body)
+                return body
+            if status is not None and status not in self.RETRY_STATUSES:
+                # The host is up, the page just isn't there
+                policy.breaker.success()
+                break
+
+            retry_after = self._retry_after(response_headers)
+            if status in (429, 503):
+                policy.bucket.throttled(retry_after or 0.0)
+            if status != 429:
+                # A 429 means the host is up and busy, everything else counts towards opening the breaker
+                policy.breaker.failure()
+            delay = retry_after if retry_after is not None else backoff(attempt, self.BACKOFF, self.MAX_BACKOFF)
+            if attempt == self.RETRIES or loop.time() + delay >= give_up:
+                break
+            self._metrics.host_event(host, 'retry')
+            await asyncio.sleep(delay)
+
+        if cached is not None:
+            # An old copy is better than nothing when the site is unreachable
+            self._metrics.cache('http', 'stale')
+            return cached['body']
+        if cacheable:
+            self._metrics.cache('http', 'miss')
+        return None
+
+    # CircuitBreaker.wait() for the event loop: True once a request may be sent,
+    # False if the breaker stays open past give_up, a loop.time() value
+    async def _wait_for_breaker(self, host, breaker, give_up):
+        loop = asyncio.get_running_loop()
+        waited = False
+        while not breaker.allow():
+            pause = breaker.wait_time(time.monotonic() + give_up - loop.time())
+            if pause is None:
+                return False
+            if not waited:
+                self._metrics.host_event(host, 'circuit_wait')
+                waited = True
+            await asyncio.sleep(pause)
+        return True
+
+    # One attempt: (status, body, headers, error, seconds), body only for a 200, status None if nothing came back
+    async def _request(self, url, headers, remaining):
+        timeout = aiohttp.ClientTimeout(total=min(self._timeout.total, remaining), connect=self._timeout.connect)
+        async with self._semaphore:
+            # Latency is measured from the request start, not from the time spent waiting for a slot
+            start = time.perf_counter()
+            try:
+                async with self._session.get(url, headers=headers, timeout=timeout) as response:
+                    body = await response.read() if response.status == 200 else None
+                    return response.status, body, response.headers, None, time.perf_counter() - start
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                error = 'timeout' if isinstance(error, asyncio.TimeoutError) else type(error).__name__
+                return None, None, None, error, time.perf_counter() - start
+
+    # Seconds asked for by a Retry-After header (seconds or an HTTP date), None if there is none
+    def _retry_after(self, headers):
+        value = headers.get('Retry-After') if headers is not None else None
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0.0), self.MAX_RETRY_AFTER)
+
+    # concurrent.futures.Future for one page, usable from any thread
+    def submit(self, url, headers=None):
+        return asyncio.run_coroutine_threadsafe(self.get(url, headers), self._start())
+
+    def fetch(self, url, headers=None):
+        return self.submit(url, headers).result()
+
+    # Download many pages at once and return {url: body or None}
+    # on_done(url, body) is called as each page finishes, pages still running after timeout seconds are dropped
+    def fetch_all(self, urls, headers=None, timeout=None, on_done=None):
+        futures = {}
+        for url in dict.fromkeys(urls):
+            futures[self.submit(url, headers)] = url
+
+        pages = {url: None for url in futures.values()}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                url = futures[future]
+                pages[url] = future.result()
+                if on_done:
+                    on_done(url, pages[url])
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+        return pages
+
+
+_shared_fetcher = None
+_shared_lock = threading.Lock()
+
+
+# Fetcher for one-off pages (Wikipedia, MarketWatch) shared by scrape.py and api.py
+def shared_fetcher():
+    global _shared_fetcher
+    with _shared_lock:
+        if _shared_fetcher is None:
+            _shared_fetcher = AsyncFetcher(rate_limits={})
+        return _shared_fetcher
@@ -6,6 +6,12 @@ import tkinter
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox
+import multiprocessing
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import partial
 from tkinter import X
@@ -17,11 +23,15 @@ from ttkthemes import ThemedStyle
 matplotlib.use('TkAgg')
 matplotlib.rcParams['axes.unicode_minus'] = False
 
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from matplotlib.backend_bases import key_press_handler
-import mplfinance as mpf
+from matplotlib.figure import Figure
 
 from api import CompanyInfo, SPPrice
+from charts import EarningsChart
+from search import SearchIndex
+from tablemodel import TableModel
 
 
 # Make date strings from date objects for GUI
@@ -43,31 +53,74 @@ class StockChart(ttk.Frame):
         ttk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
 
+        self._redraw_pending = False
+        self._released = False
         try:
             self.symbol = info['symbol']
-            start = info['dates'].min()
-            self.plot(self.symbol, str(start)[:10], to_datestrings(info['dates']))
+            # Pages built in the background come with the figure already rendered
+            if info.get('figure') is None:
+                info = {**info, **self.render(self.company_info, self.symbol, info['dates'])}
+            self.plot(info['figure'], info['chart'])
         except:
             tk.Label(self, text=f"Cannot get chart for {self.symbol}").pack()
 
+    # Chart figure rendered off-screen with Agg, never touches Tk so it can run on a worker thread
+    # The chart is drawn at screen resolution and drawn again in more detail when zoomed in
+    @staticmethod
+    def render(company_info, symbol, dates):
+        stock_data = company_info.stock_data(symbol, str(dates.min())[:10])
+        fig = Figure(figsize=(8, 5.75))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        chart = EarningsChart(stock_data, dates, max_points=int(fig.get_figwidth() * fig.dpi))
+        chart.draw(ax)
+        fig.canvas.draw()
+        return {'figure': fig, 'chart': chart}
+
     # Use matplotlib library tk connector to plot stock data
     # Function made in tk
-    def plot(self, symbol, start, dates):
-        stock_data = self.company_info.stock_data(symbol, start)
-        markers = ["^" if _ in dates else None for _ in to_datestrings(
-            stock_data.index)]
-        adp = mpf.make_addplot(
-            stock_data['Open'] * 0.95, marker=markers, type="scatter", markersize=200)
-
-        fig = mpf.plot(stock_data, type="line",
-                       addplot=adp, returnfig=True)
-        canvas = FigureCanvasTkAgg(fig[0], master=self)
-        canvas.mpl_connect("key_press_event", key_press_handler)
-        widget = canvas.get_tk_widget()
-        toolbar = NavigationToolbar2Tk(canvas, self, pack_toolbar=True)
+    def plot(self, fig, chart):
+        self.chart = chart
+        self.ax = fig.axes[0]
+        self.canvas = FigureCanvasTkAgg(fig, master=self)
+        # Handlers connected from here on belong to this page, see _release
+        self._callback_baseline = self._callback_ids()
+        self.canvas.mpl_connect("key_press_event", key_press_handler)
+        self._xlim_cid = self.ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        widget = self.canvas.get_tk_widget()
+        toolbar = NavigationToolbar2Tk(self.canvas, self, pack_toolbar=True)
         toolbar.update()
         widget.pack()
-        canvas.draw()
+        widget.bind('<Destroy>', self._release)
+        self.canvas.draw()
+
+    # Cached figures are shown again on later pages, so the handlers this page's canvas
+    # and toolbar connected to the figure are dropped with the page
+    def _release(self, event=None):
+        if self._released:
+            return
+        self._released = True
+        for cid in self._callback_ids() - self._callback_baseline:
+            self.canvas.mpl_disconnect(cid)
+        self.ax.callbacks.disconnect(self._xlim_cid)
+
+    def _callback_ids(self):
+        return {cid for callbacks in self.canvas.callbacks.callbacks.values() for cid in callbacks}
+
+    # Zoom and pan change the x limits many times per second, so the redraw waits for Tk to be idle
+    def _on_xlim_changed(self, ax):
+        if not self._redraw_pending and self.chart.needs_redraw(ax):
+            self._redraw_pending = True
+            self.after_idle(self._redraw, ax)
+
+    def _redraw(self, ax):
+        if self._released:
+            return
+        try:
+            self.chart.draw_view(ax)
+            self.canvas.draw_idle()
+        finally:
+            self._redraw_pending = False
 
 # Treeview with sorting for each column
 class SortTreeview(ttk.Treeview):
@@ -102,6 +155,85 @@ class SortTreeview(ttk.Treeview):
 
         self._sort(column, reverse, _str_to_datetime, self._sort_by_date)
 
+
+# Sortable treeview that only has items for the rows on screen
+# Rows live in a TableModel: scrolling and sorting put other model rows into the same few items,
+# so the cost of both depends on the height of the window, not the number of rows
+class VirtualTreeview(SortTreeview):
+    def __init__(self, parent, types, model, *args, **kwargs):
+        SortTreeview.__init__(self, parent, types, *args, **kwargs)
+        self.model = model
+        # Model index of the first row on screen
+        self.top = 0
+        self._refresh_pending = False
+        try:
+            self._row_height = int(ttk.Style().lookup('Treeview', 'rowheight'))
+        except (TypeError, ValueError):
+            self._row_height = 20
+
+        self.scrollbar = ttk.Scrollbar(parent, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.bind('<Configure>', lambda event: self.refresh())
+        self.bind('<MouseWheel>', lambda event: self.scroll(-1 if event.delta > 0 else 1, 'units'))
+        self.bind('<Button-4>', lambda event: self.scroll(-1, 'units'))
+        self.bind('<Button-5>', lambda event: self.scroll(1, 'units'))
+        self.bind('<Prior>', lambda event: self.scroll(-1, 'pages'))
+        self.bind('<Next>', lambda event: self.scroll(1, 'pages'))
+
+    # Rows that fit in the widget, less one for the headings
+    def visible_rows(self):
+        return max(self.winfo_height() // self._row_height - 1, 1)
+
+    # Show the model rows from self.top in the items on screen
+    def refresh(self):
+        self._refresh_pending = False
+        visible = self.visible_rows()
+        self.top = max(min(self.top, len(self.model) - visible), 0)
+        count = max(min(visible, len(self.model) - self.top), 0)
+
+        items = self.get_children('')
+        for item in items[count:]:
+            self.delete(item)
+        for index in range(count):
+            values = self.model.values(self.top + index)
+            if index < len(items):
+                self.item(items[index], values=values)
+            else:
+                self.insert('', tk.END, values=values)
+
+        if len(self.model) > 0:
+            self.scrollbar.set(self.top / len(self.model), (self.top + count) / len(self.model))
+        else:
+            self.scrollbar.set(0, 1)
+
+    # Refresh once Tk is idle, for bursts of row updates
+    def refresh_later(self):
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            self.after_idle(self.refresh)
+
+    def scroll(self, number, what='units'):
+        step = self.visible_rows() if what == 'pages' else 1
+        self._move_to(self.top + int(number) * step)
+        return 'break'
+
+    def _on_scrollbar(self, action, number, what=None):
+        if action == 'moveto':
+            self._move_to(int(float(number) * len(self.model)))
+        else:
+            self.scroll(number, what)
+
+    def _move_to(self, top):
+        # A selected item would now show another row
+        self.selection_remove(self.selection())
+        self.top = top
+        self.refresh()
+
+    # Sorting is done by the model, the items on screen are filled in again from the top
+    def _sort(self, column, reverse, data_type, callback):
+        self.model.sort(column, reverse)
+        self._move_to(0)
+        self.heading(column, command=partial(callback, column, not reverse))
+
 # Button class
 class NavButton(ttk.Frame):
     def __init__(self, parent, command=None, text=None, image=None, *args, **kwargs):
@@ -118,6 +250,7 @@ class CompanyDetailView:
     def __init__(self, symbol):
         self.company_info = CompanyInfo()
         changes = self.company_info.earnings_averages(symbol)
+        stats = self.company_info.earnings_stats(symbol)
         self.info = {
             'symbol': symbol,
             'earnings_dates': self.company_info.earnings_dates(symbol),
@@ -125,6 +258,8 @@ class CompanyDetailView:
             'average_point_change': (round(changes['point_avg'], 2)),
             'average_percent_change': (round(changes['percent_avg'], 2)),
             'average_percent_change_pos': True if changes['percent_avg'] > 0 else False,
+            'median_percent_change': round(stats.get('percent_median', float('nan')), 2),
+            'up_rate': round(stats.get('up_rate', float('nan')) * 100, 0),
             'description': self.company_info.company_detail(symbol)
         }
 
@@ -169,8 +304,6 @@ class EarningsInfoView(InfoView):
         prices = SPPrice.prices([symbol])
         for index, values in enumerate(self.company_info.earnings_change(self.symbol)):
             price = prices[symbol]
-            avgs = self.company_info.earnings_averages(symbol)
-            next_earnings_date = self.company_info.next_earnings_date(symbol)
             info['values'][index] = tuple(
                 self.format_values(info['sort'], [price, *values]))
 
@@ -193,17 +326,39 @@ class SPInfoView(InfoView):
             'values': {}
         }
 
-        prices = SPPrice.prices([_['symbol'] for _ in self.company_info.companies])
-        for company in self.company_info.companies:
-            symbol = company['symbol']
-            name = company['name']
-            price = prices[symbol]
-            avgs = self.company_info.earnings_averages(symbol)
-            next_earnings_date = self.company_info.next_earnings_date(symbol)
-            info['values'][symbol] = tuple(self.format_values(info['sort'], [
-                symbol, name, price, avgs['point_avg'], avgs['percent_avg'], next_earnings_date]))
-
+        # Prices are blank until load_prices() brings them in, so the window never waits for the quote feed
         self.info = info
+        for company in self.company_info.companies:
+            info['values'][company['symbol']] = self.row(company['symbol'], company['name'])
+
+    # Fetch the current prices in the background
+    # on_update(symbol) is called from that thread for each row whose price came in
+    def load_prices(self, on_update):
+        def on_fetched(symbols):
+            for symbol in symbols:
+                on_update(symbol)
+
+        SPPrice.prices([_['symbol'] for _ in self.company_info.companies], wait=False, on_fetched=on_fetched)
+
+    # Table values for one company
+    def row(self, symbol, name):
+        price = SPPrice.cached_prices([symbol])[symbol]
+        # Companies without stored data yet show zeros until the refresh reaches them
+        avgs = self.company_info.earnings_averages(symbol) or {'point_avg': None, 'percent_avg': None}
+        # Stored date only, passed dates are looked up in the background and update the row
+        next_earnings_date = self.company_info.cached_next_earnings_date(symbol)
+        return tuple(self.format_values(self.info['sort'], [
+            symbol, name, price, avgs['point_avg'], avgs['percent_avg'], next_earnings_date]))
+
+    # Rebuild the row of a symbol that changed in the background refresh
+    # Returns the new values, or None if the symbol left the index
+    def update(self, symbol):
+        if not any(_['symbol'] == symbol for _ in self.company_info.companies):
+            self.info['values'].pop(symbol, None)
+            return None
+        values = self.row(symbol, self.company_info.company_name(symbol))
+        self.info['values'][symbol] = values
+        return values
 
 
 # InfoPane GUI Elements
@@ -215,8 +370,9 @@ class InfoPane(ttk.Frame):
         self.header = ttk.Label(
             self, text=info['text'], anchor=tk.CENTER, style='Heading.TLabel')
 
-        self.list = SortTreeview(
-            self, info['sort'], columns=info['columns'], show='headings')
+        self.model = TableModel(info['columns'], info['sort'], info['values'])
+        self.list = VirtualTreeview(
+            self, info['sort'], self.model, columns=info['columns'], show='headings')
 
         if onclick:
             self.list.bind("<ButtonRelease-1>", onclick(self.list))
@@ -226,12 +382,19 @@ class InfoPane(ttk.Frame):
             self.list.heading(
                 column, sort_by=info['sort'][index], text=column, anchor=tk.CENTER)
 
-        for value in info['values']:
-            self.list.insert('', tk.END, values=info['values'][value])
-
         self.header.pack(side=tk.TOP, fill=tk.X)
+        self.list.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.list.pack(fill=tk.BOTH, expand=True)
 
+    # Replace the values of a row, adding it if it is new
+    def update_row(self, key, values):
+        self.model.set_row(key, values)
+        self.list.refresh_later()
+
+    def remove_row(self, key):
+        self.model.remove_row(key)
+        self.list.refresh_later()
+
 
 # 3 classes needed for Search
 
@@ -269,13 +432,26 @@ class SearchResult(ttk.Frame):
 
 
 # Search text entry/button and search function
+# Matches come from the application's SearchIndex and are listed below the entry as you type
 class SearchBox(ttk.Frame):
+    # Matches listed while typing, and the typing pause (ms) before they are looked up
+    SUGGESTIONS = 8
+    SUGGEST_DELAY = 100
+
     def __init__(self, parent, root, tree, *args, **kwargs):
         ttk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
         self.root = root
         self.tree = tree
+        self.index = root.search_index
         self.entry = ttk.Entry(self)
+        self.entry.bind('<KeyRelease>', self._on_key)
+        self.entry.bind('<Return>', lambda event: self.search())
+        self._suggest_job = None
+        self._suggested = []
+        self.suggestions = tk.Listbox(self, height=self.SUGGESTIONS, activestyle='none')
+        self.suggestions.bind('<Double-Button-1>', self._open_suggestion)
+        self.suggestions.bind('<Return>', self._open_suggestion)
 
         try:
             self.searchIcon = tk.PhotoImage(
@@ -289,6 +465,33 @@ class SearchBox(ttk.Frame):
         self.entry.pack(side=tk.TOP, fill=tk.X, padx=3, pady=3)
         self.button.pack(side=tk.BOTTOM, padx=4, pady=3)
 
+    # Look the query up once typing pauses
+    def _on_key(self, event):
+        if event.keysym in ('Return', 'Up', 'Down'):
+            if event.keysym == 'Down' and self._suggested:
+                self.suggestions.focus_set()
+                self.suggestions.selection_set(0)
+            return
+        if self._suggest_job is not None:
+            self.after_cancel(self._suggest_job)
+        self._suggest_job = self.after(self.SUGGEST_DELAY, self._suggest)
+
+    def _suggest(self):
+        self._suggest_job = None
+        self._suggested = self.index.search(self.entry.get(), limit=self.SUGGESTIONS)
+        self.suggestions.delete(0, tk.END)
+        for symbol in self._suggested:
+            self.suggestions.insert(tk.END, f"{symbol}  {self.index.name(symbol)}")
+        if self._suggested:
+            self.suggestions.pack(side=tk.TOP, fill=tk.X, padx=3, after=self.entry)
+        else:
+            self.suggestions.pack_forget()
+
+    def _open_suggestion(self, event=None):
+        selection = self.suggestions.curselection()
+        if len(selection) > 0 and selection[0] < len(self._suggested):
+            self.root.showEarningsDetail(self._suggested[selection[0]])
+
     def search(self):
         # Function for search bar entry
         query = self.entry.get()
@@ -296,9 +499,9 @@ class SearchBox(ttk.Frame):
         if query == "":
             return tk.messagebox.showerror("Error", "No matching S&P 500 Company found")
         selections = []
-        for child in self.tree.get_children():
-            values = self.tree.item(child)['values']
-            if any([query.lower() == str(_).lower()[:len(query)] for _ in values]):
+        for symbol in self.index.search(query):
+            values = self.tree.model.row(symbol)
+            if values is not None:
                 selections.append(values)
 
         if not selections:
@@ -360,6 +563,10 @@ class CompanyDetailPane(ttk.Frame):
             frame, text=f"In USD: ${info['average_point_change']}", compound=tk.RIGHT,
             style="Subheading.TLabel").pack(side=tk.RIGHT, padx=1)
         frame.pack(padx=2)
+        ttk.Label(
+            average_change, text=f"Median: {info['median_percent_change']}%   "
+                                 f"Up after {info['up_rate']}% of reports",
+            style="Subheading.TLabel").pack(pady=2)
         ExpandingText(average_change, info['description']).pack(
             side=tk.BOTTOM, expand=True, pady=4)
         average_change.pack()
@@ -420,6 +627,78 @@ class BaseRightCol(ThreeRowFrame):
             side=tk.RIGHT, padx=20, pady=20, fill=X, expand=True)
 
 
+# Builds company pages on worker threads: the data lookups and an off-screen render of the chart
+# The Tk thread only puts finished pages on screen
+# Recent pages are kept in an LRU cache so going back and forth between symbols is instant
+class CompanyPageBuilder:
+    CACHE_SIZE = 8
+
+    # on_ready(symbol, built) is called from the worker thread once a page is built (built is True) or has failed
+    def __init__(self, on_ready, workers=2):
+        self._on_ready = on_ready
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._cache = OrderedDict()
+        self._pending = set()
+        # Symbols whose data changed while their page was being built
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    # Finished page of a symbol, or None if it isn't built yet
+    def get(self, symbol):
+        with self._lock:
+            page = self._cache.get(symbol)
+            if page is not None:
+                self._cache.move_to_end(symbol)
+            return page
+
+    # Start building a page unless it is already cached or being built
+    def request(self, symbol):
+        with self._lock:
+            if symbol in self._cache or symbol in self._pending:
+                return
+            self._pending.add(symbol)
+        self._pool.submit(self._build, symbol)
+
+    # Forget a page whose data changed, a build already running for it starts over once it is done
+    def invalidate(self, symbol):
+        with self._lock:
+            self._cache.pop(symbol, None)
+            if symbol in self._pending:
+                self._stale.add(symbol)
+
+    def _build(self, symbol):
+        page = None
+        try:
+            detail = CompanyDetailView(symbol).info
+            page = {
+                'detail': detail,
+                'earnings': EarningsInfoView(symbol).info,
+                'chart': {'symbol': symbol, 'dates': detail['earnings_dates']},
+            }
+            try:
+                page['chart'].update(StockChart.render(CompanyInfo(), symbol, detail['earnings_dates']))
+            except Exception:
+                # StockChart shows that the chart is missing
+                pass
+        except Exception:
+            page = None
+
+        with self._lock:
+            # Built from data that has changed since, so it is built again
+            rebuild = symbol in self._stale
+            self._stale.discard(symbol)
+            if not rebuild:
+                self._pending.discard(symbol)
+                if page is not None:
+                    self._cache[symbol] = page
+                    while len(self._cache) > self.CACHE_SIZE:
+                        self._cache.popitem(last=False)
+        if rebuild:
+            self._pool.submit(self._build, symbol)
+        else:
+            self._on_ready(symbol, page is not None)
+
+
 # App Main Frame
 class MainApplication(ttk.Frame):
     def __init__(self, parent, views, *args, **kwargs):
@@ -452,14 +731,81 @@ class MainApplication(ttk.Frame):
             'home_command': lambda: self.showSPWindow()
         }
 
+        # Symbols changed by the background refresh, filled from the worker thread
+        self.updates = queue.Queue()
+        self.sp_pane = None
+
+        # Symbol and name index for the search box, kept in line with the company list
+        self.search_index = SearchIndex(views['sp'].company_info.companies)
+
+        # Company pages finished by the page builder threads
+        self.pages_ready = queue.Queue()
+        self.pages = CompanyPageBuilder(lambda symbol, built: self.pages_ready.put((symbol, built)))
+        # Symbol of the company page waiting for its build, None when no page is loading
+        self.loading = None
+        # Symbol of the company page on screen, None when none is shown
+        self.showing = None
+
         self.showSPWindow()
         # Show home page
+        self.after(self.UPDATE_INTERVAL, self.applyUpdates)
+
+    # How often (ms) rows changed by the background refresh are pulled into the table
+    UPDATE_INTERVAL = 250
+
+    # Apply symbol updates from the background refresh on the Tk thread
+    def applyUpdates(self):
+        symbols = set()
+        while True:
+            try:
+                symbols.add(self.updates.get_nowait())
+            except queue.Empty:
+                break
+
+        # Companies can join or leave the index during the refresh
+        if symbols:
+            self.search_index.update(self.views['sp'].company_info.companies)
+
+        pane = self.sp_pane if self.sp_pane is not None and self.sp_pane.winfo_exists() else None
+        for symbol in symbols:
+            self.pages.invalidate(symbol)
+            # The page on screen stays up while it is rebuilt from the new data
+            if symbol == self.showing:
+                self.loading = symbol
+                self.pages.request(symbol)
+            values = self.views['sp'].update(symbol)
+            if pane is None:
+                continue
+            if values is None:
+                pane.remove_row(symbol)
+            else:
+                pane.update_row(symbol, values)
+
+        while True:
+            try:
+                symbol, built = self.pages_ready.get_nowait()
+            except queue.Empty:
+                break
+            if symbol != self.loading:
+                continue
+            if built and self.pages.get(symbol) is None:
+                # Its data changed after the page was built
+                self.pages.request(symbol)
+            elif built or symbol != self.showing:
+                self.showEarningsDetail(symbol, build=False)
+            else:
+                # The rebuild failed, the page on screen is kept
+                self.loading = None
+
+        self.after(self.UPDATE_INTERVAL, self.applyUpdates)
 
     # Function defined to show the home page of the program
     def showSPWindow(self):
         mainwindow = getattr(self, 'mainwindow', None)
         if mainwindow:
             mainwindow.destroy()
+        self.loading = None
+        self.showing = None
 
         # the two column layout
         twocols = TwoColFrame(self)
@@ -470,6 +816,7 @@ class MainApplication(ttk.Frame):
         infopane = InfoPane(
             twocols.left, self.sp_info, onclick=self.spOnClick)
         infopane.pack(fill=tk.BOTH, expand=True, padx=20, pady=70)
+        self.sp_pane = infopane
 
         # right column
         rightcol = BaseRightCol(twocols.right, self.button_info)
@@ -502,7 +849,9 @@ class MainApplication(ttk.Frame):
         rightcol.pack(expand=True, pady=30, padx=15)
 
     # shows the Company Page for a symbol, creates a window
-    def showEarningsDetail(self, symbol):
+    # Pages are built in the background, a loading message shows until applyUpdates gets the page
+    # build=False shows a failed build instead of trying again
+    def showEarningsDetail(self, symbol, build=True):
         mainwindow = getattr(self, 'mainwindow', None)
         if mainwindow:
             mainwindow.destroy()
@@ -512,21 +861,28 @@ class MainApplication(ttk.Frame):
         twocols.pack(fill=tk.BOTH, anchor=tk.CENTER, expand=True)
         self.mainwindow = twocols
 
-        companydetail = CompanyDetailView(symbol)
+        page = self.pages.get(symbol)
+        self.loading = symbol if page is None and build else None
+        self.showing = symbol if page is not None else None
 
         # left column
-        earnings_info = EarningsInfoView(symbol)
-        infopane = InfoPane(twocols.left, earnings_info.info)
-        CompanyDetailPane(infopane, companydetail.info).pack()
-        infopane.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
+        if page is None:
+            text = f"Loading {symbol}..." if build else f"Cannot load {symbol}"
+            ttk.Label(twocols.left, text=text, style='Subheading.TLabel').pack(padx=20, pady=70)
+        else:
+            infopane = InfoPane(twocols.left, page['earnings'])
+            CompanyDetailPane(infopane, page['detail']).pack()
+            infopane.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
 
         # right column
         rightrows = BaseRightCol(twocols.right, self.button_info)
-        StockChart(
-            rightrows.mid,
-            {'dates': companydetail.info['earnings_dates'], 'symbol': companydetail.info['symbol']}).pack()
+        if page is not None:
+            StockChart(rightrows.mid, page['chart']).pack()
         rightrows.pack(fill=tk.BOTH, pady=70, padx=20, anchor='w')
 
+        if self.loading:
+            self.pages.request(symbol)
+
     def showHelpWindow(self):
         top = tk.Toplevel(self.root)
         with open('README.txt', encoding="utf-8") as readme:
@@ -548,6 +904,11 @@ class MainApplication(ttk.Frame):
 
 # Running main window
 if __name__ == "__main__":
+    # The page parsing workers of parsing.py start this program again, a frozen build has to hand them off here
+    multiprocessing.freeze_support()
+    # Time to first window is printed to the console once the home page is drawn
+    start_time = time.perf_counter()
+
     root = tk.Tk()
     root.title("S&P 500 Tracker")
 
@@ -574,11 +935,17 @@ if __name__ == "__main__":
     # Window size
     root.geometry("1440x1024")
 
+    # Start from the last stored data, the refresh pipeline runs in the background
+    company_info = CompanyInfo(lazy=True)
     spinfoview = SPInfoView()
     views = {'sp': spinfoview}
 
     root.protocol("WM_DELETE_WINDOW", root.quit())
 
 
-    MainApplication(root, views).pack(side="top", fill="both", expand=True)
+    app = MainApplication(root, views)
+    app.pack(side="top", fill="both", expand=True)
+    root.after_idle(lambda: print(f"\n\nFirst window shown in {time.perf_counter() - start_time:.2f}s\n\n"))
+    spinfoview.load_prices(on_update=app.updates.put)
+    company_info.refresh_in_background(on_update=app.updates.put)
     root.mainloop()
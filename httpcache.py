@@ -0,0 +1,148 @@
+# This HTTP Cache file keeps downloaded pages on disk for the scrapers in scrape.py and api.py
+# Pages younger than their source's time to live are served without a request,
+# older ones are revalidated with ETag / Last-Modified so an unchanged page costs a 304,
+# and the least recently used pages are dropped once the cache is over its size limit
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from os.path import join
+from urllib.parse import urlsplit
+
+
+# On-disk HTTP response cache: page bodies are files, the index is a SQLite table
+class HTTPCache:
+    # Seconds a page is served without asking the server, per host
+    # Hosts not listed here are never cached (live quotes, price data)
+    _DEFAULT_TTLS = {
+        'en.wikipedia.org': 24 * 60 * 60,
+        'www.zacks.com': 6 * 60 * 60,
+        'www.marketwatch.com': 7 * 24 * 60 * 60,
+    }
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            stored_at REAL,
+            accessed_at REAL,
+            size INTEGER
+        );
+    """
+
+    def __init__(self, path='http_cache', max_bytes=256 * 1024 * 1024, ttls=None):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._ttls = self._DEFAULT_TTLS if ttls is None else ttls
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(join(path, 'index.db'), check_same_thread=False)
+        self._db.executescript(self._SCHEMA)
+
+    # Time to live for a URL, None if it should not be cached
+    def ttl(self, url):
+        return self._ttls.get(urlsplit(url).hostname)
+
+    def cacheable(self, url):
+        return self.ttl(url) is not None
+
+    # Cached page as {'body', 'etag', 'last_modified', 'fresh'}, or None
+    # fresh means it is still within its time to live and needs no request at all
+    def lookup(self, url):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, stored_at FROM pages WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self._file(url), 'rb') as page:
+                    body = page.read()
+            except OSError:
+                with self._db:
+                    self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                return None
+            with self._db:
+                self._db.execute("UPDATE pages SET accessed_at = ? WHERE url = ?", (now, url))
+
+        etag, last_modified, stored_at = row
+        return {
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': now - stored_at < (self.ttl(url) or 0),
+        }
+
+    # Headers that turn a request for a cached page into a conditional request
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Save a 200 response
+    def store(self, url, headers, body):
+        if not self.cacheable(url):
+            return
+        now = time.time()
+        # Write to a temporary file first so readers never see half a page
+        filename = self._file(url)
+        temp_filename = '%s.%d.tmp' % (filename, threading.get_ident())
+        with open(temp_filename, 'wb') as page:
+            page.write(body)
+        with self._lock:
+            os.replace(temp_filename, filename)
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pages (url, etag, last_modified, stored_at, accessed_at, size) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, headers.get('ETag'), headers.get('Last-Modified'), now, now, len(body)))
+            self._evict()
+
+    # A 304 response: the cached page is good for another time to live
+    def revalidated(self, url, headers):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE pages SET stored_at = ?, accessed_at = ?, "
+                "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                (now, now, headers.get('ETag'), headers.get('Last-Modified'), url))
+
+    # Drop least recently used pages until the cache fits in max_bytes
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        rows = self._db.execute("SELECT url, size FROM pages ORDER BY accessed_at").fetchall()
+        with self._db:
+            for url, size in rows:
+                if total <= self._max_bytes:
+                    break
+                self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                try:
+                    os.remove(self._file(url))
+                except OSError:
+                    pass
+                total -= size
+
+    def _file(self, url):
+        return join(self._path, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+# The cache every scraper uses unless it is given its own
+def shared_cache():
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = HTTPCache()
+        return _shared_cache
@@ -11,18 +11,21 @@ PyInstaller.__main__.run([
     '--icon=.\icons\icon.ico'
 ])
 
-if exists('./dist') and exists('./icons') and exists('./sp_dict.pickle'):
+if exists('./dist') and exists('./icons') and exists('./sp_data.db'):
     try:
         mkdir('./dist/icons')
         for filename in glob('./icons/*'):
             copy(filename, './dist/icons')
-        copy('./sp_dict.pickle', './dist')
+        copy('./sp_data.db', './dist')
+        # Ready-made earnings snapshot so the first start doesn't have to build it
+        if exists('./sp_data.snap'):
+            copy('./sp_data.snap', './dist')
         copy('./README.txt', './dist')
     except FileExistsError:
         if exists('./dist/icons'):
             print('ICON FILES ALREADY EXIST IN DIST FOLDER.')
-        if exists('./dist/sp_dict.pickle'):
-            print('sp_dict.pickle ALREADY EXIST IN DIST FOLDER.')
+        if exists('./dist/sp_data.db'):
+            print('sp_data.db ALREADY EXIST IN DIST FOLDER.')
         if exists('./dist/README.txt'):
             print('README.txt ALREADY EXIST IN DIST FOLDER.')
     except:
@@ -0,0 +1,252 @@
+# This Metrics file collects timings and counters from the refresh pipeline
+# Stage wall times, HTTP requests per host, cache outcomes and the symbols each stage lost
+# are recorded in one place and can be exported as JSON or in the Prometheus text format:
+#     with metrics.shared_metrics().stage('earnings'):
+#         ...
+#     print(metrics.shared_metrics().to_prometheus())
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Thread safe collection of pipeline measurements
+# Counters only grow, so they can be scraped as Prometheus counters;
+# failures are kept for the last run of each stage only
+class Metrics:
+    # Upper bounds in seconds of the request latency histogram buckets, +Inf is added on export
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # Failures kept per stage, a dead site would otherwise list every symbol each run
+    MAX_FAILURES = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # name -> {'runs', 'seconds', 'last_seconds', 'running'}, in the order stages first ran
+        self._stages = OrderedDict()
+        # host -> {'requests', 'bytes', 'statuses': {status: count}, 'errors': {kind: count},
+        #          'buckets': [count per LATENCY_BUCKETS bound and +Inf], 'latency_sum',
+        #          'events': {kind: count}, 'rate'}
+        self._hosts = {}
+        # cache name -> {outcome: count}
+        self._caches = {}
+        # stage -> {symbol: reason}
+        self._failures = {}
+
+    # Time a block of work as one run of a stage
+    # Failures recorded without a stage while the block runs on this thread belong to it
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self._stage(name)['running'] = True
+        self.clear_failures(name)
+        previous = getattr(self._local, 'stage', None)
+        self._local.stage = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._local.stage = previous
+            self.add_stage_run(name, time.perf_counter() - start)
+
+    # One run of a stage timed by the caller, such as stages whose tasks overlap in scheduler.py
+    def add_stage_run(self, name, seconds):
+        with self._lock:
+            entry = self._stage(name)
+            entry['runs'] += 1
+            entry['seconds'] += seconds
+            entry['last_seconds'] = seconds
+            entry['running'] = False
+
+    # Forget the failures of a stage's last run when a new one starts
+    def clear_failures(self, name):
+        with self._lock:
+            self._failures[name] = {}
+
+    # One HTTP request, status is None when no response came back and error says why
+    def request(self, host, seconds, status=None, size=0, error=None):
+        with self._lock:
+            entry = self._host(host)
+            entry['requests'] += 1
+            entry['bytes'] += size
+            entry['latency_sum'] += seconds
+            entry['buckets'][self._bucket(seconds)] += 1
+            if status is not None:
+                entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            if error is not None:
+                entry['errors'][error] = entry['errors'].get(error, 0) + 1
+
+    # Something the request layer did for a host, such as 'retry', 'circuit_wait' or 'circuit_open'
+    def host_event(self, host, event):
+        with self._lock:
+            events = self._host(host)['events']
+            events[event] = events.get(event, 0) + 1
+
+    # Requests per second the host's rate limiter currently allows
+    def host_rate(self, host, rate):
+        with self._lock:
+            self._host(host)['rate'] = rate
+
+    # outcome is 'hit', 'miss', 'revalidated' or 'stale' (an old copy served while a new one is fetched or can't be)
+    def cache(self, name, outcome, count=1):
+        with self._lock:
+            outcomes = self._caches.setdefault(name, {})
+            outcomes[outcome] = outcomes.get(outcome, 0) + count
+
+    # A symbol a stage could not finish, reason is a short text such as 'timeout'
+    def failed(self, symbol, reason, stage=None):
+        stage = stage or getattr(self._local, 'stage', None) or 'other'
+        with self._lock:
+            failures = self._failures.setdefault(stage, {})
+            if symbol in failures or len(failures) < self.MAX_FAILURES:
+                failures[symbol] = reason
+
+    # {symbol: reason} of one stage, or {stage: {symbol: reason}} of all of them
+    def failures(self, stage=None):
+        with self._lock:
+            if stage is not None:
+                return dict(self._failures.get(stage, {}))
+            return {name: dict(failures) for name, failures in self._failures.items() if failures}
+
+    # Everything recorded as plain dicts and lists
+    def snapshot(self):
+        with self._lock:
+            hosts = {}
+            for host, entry in self._hosts.items():
+                hosts[host] = {
+                    'requests': entry['requests'],
+                    'bytes': entry['bytes'],
+                    'statuses': {str(status): count for status, count in entry['statuses'].items()},
+                    'errors': dict(entry['errors']),
+                    'events': dict(entry['events']),
+                    'rate': entry['rate'],
+                    'latency_seconds_sum': round(entry['latency_sum'], 6),
+                    'latency_buckets': {str(bound): count for bound, count in
+                                        zip((*self.LATENCY_BUCKETS, '+Inf'), self._cumulative(entry['buckets']))},
+                }
+            caches = {}
+            for name, outcomes in self._caches.items():
+                lookups = sum(outcomes.values())
+                hits = outcomes.get('hit', 0) + outcomes.get('revalidated', 0)
+                caches[name] = {**outcomes, 'hit_rate': round(hits / lookups, 4) if lookups else None}
+            return {
+                'stages': {name: dict(entry) for name, entry in self._stages.items()},
+                'hosts': hosts,
+                'caches': caches,
+                'failures': {name: dict(failures) for name, failures in self._failures.items() if failures},
+            }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.snapshot(), indent=indent)
+
+    # Prometheus text exposition format, version 0.0.4
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        stages = snapshot['stages']
+        metric('sp_stage_runs_total', 'counter', "Completed runs of each refresh stage.",
+               [({'stage': name}, entry['runs']) for name, entry in stages.items()])
+        metric('sp_stage_seconds_total', 'counter', "Wall time spent in each refresh stage.",
+               [({'stage': name}, entry['seconds']) for name, entry in stages.items()])
+        metric('sp_stage_last_seconds', 'gauge', "Wall time of the last completed run of each refresh stage.",
+               [({'stage': name}, entry['last_seconds']) for name, entry in stages.items()
+                if entry['last_seconds'] is not None])
+
+        hosts = snapshot['hosts']
+        metric('sp_http_requests_total', 'counter', "HTTP requests sent, by host and response status.",
+               [({'host': host, 'status': status}, count) for host, entry in hosts.items()
+                for status, count in entry['statuses'].items()])
+        metric('sp_http_errors_total', 'counter', "HTTP requests without a response, by host and error.",
+               [({'host': host, 'error': error}, count) for host, entry in hosts.items()
+                for error, count in entry['errors'].items()])
+        metric('sp_http_events_total', 'counter', "Retries, waits for and requests refused by an open circuit, by host.",
+               [({'host': host, 'event': event}, count) for host, entry in hosts.items()
+                for event, count in entry['events'].items()])
+        metric('sp_http_rate_limit', 'gauge', "Requests per second currently allowed, by host.",
+               [({'host': host}, entry['rate']) for host, entry in hosts.items() if entry['rate'] is not None])
+        metric('sp_http_response_bytes_total', 'counter', "Response body bytes downloaded, by host.",
+               [({'host': host}, entry['bytes']) for host, entry in hosts.items()])
+        lines.append("# HELP sp_http_request_seconds HTTP request latency, by host.")
+        lines.append("# TYPE sp_http_request_seconds histogram")
+        for host, entry in hosts.items():
+            for bound, count in entry['latency_buckets'].items():
+                lines.append(f'sp_http_request_seconds_bucket{{host="{_escape(host)}",le="{bound}"}} {count}')
+            lines.append(f'sp_http_request_seconds_sum{{host="{_escape(host)}"}} {entry["latency_seconds_sum"]}')
+            lines.append(f'sp_http_request_seconds_count{{host="{_escape(host)}"}} {entry["requests"]}')
+
+        caches = snapshot['caches']
+        metric('sp_cache_lookups_total', 'counter', "Cache lookups, by cache and outcome.",
+               [({'cache': name, 'outcome': outcome}, count) for name, outcomes in caches.items()
+                for outcome, count in outcomes.items() if outcome != 'hit_rate'])
+
+        failures = snapshot['failures']
+        metric('sp_stage_failed_symbols', 'gauge', "Symbols the last run of each stage could not finish.",
+               [({'stage': name}, len(symbols)) for name, symbols in failures.items()])
+        return "\n".join(lines) + "\n"
+
+    # Wall time per stage and failure counts, for the console at the end of a refresh
+    def summary(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, entry in snapshot['stages'].items():
+            if entry['last_seconds'] is None:
+                continue
+            failed = len(snapshot['failures'].get(name, {}))
+            lines.append(f"{name:<24}{entry['last_seconds']:>9.1f}s" + (f"  {failed} failed" if failed else ""))
+        for name, outcomes in snapshot['caches'].items():
+            if outcomes['hit_rate'] is not None:
+                lines.append(f"{name + ' cache hit rate':<24}{outcomes['hit_rate']:>9.0%}")
+        return "\n".join(lines)
+
+    def _host(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = {'requests': 0, 'bytes': 0, 'statuses': {}, 'errors': {},
+                                 'buckets': [0] * (len(self.LATENCY_BUCKETS) + 1), 'latency_sum': 0.0,
+                                 'events': {}, 'rate': None}
+        return self._hosts[host]
+
+    def _stage(self, name):
+        return self._stages.setdefault(name, {'runs': 0, 'seconds': 0.0, 'last_seconds': None, 'running': False})
+
+    # Index of the first bucket whose upper bound holds seconds
+    def _bucket(self, seconds):
+        for index, bound in enumerate(self.LATENCY_BUCKETS):
+            if seconds <= bound:
+                return index
+        return len(self.LATENCY_BUCKETS)
+
+    def _cumulative(self, buckets):
+        total = 0
+        counts = []
+        for count in buckets:
+            total += count
+            counts.append(total)
+        return counts
+
+
+# Label values are quoted, so backslashes, quotes and newlines are escaped
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_shared_metrics = None
+_shared_lock = threading.Lock()
+
+
+# Metrics every part of the pipeline records into
+def shared_metrics():
+    global _shared_metrics
+    with _shared_lock:
+        if _shared_metrics is None:
+            _shared_metrics = Metrics()
+        return _shared_metrics
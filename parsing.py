@@ -0,0 +1,234 @@
+# This Parsing file turns downloaded pages into compact results, in worker processes
+# Threads and the asyncio fetcher only move bytes; BeautifulSoup, read_html and date parsing hold the GIL,
+# so they run in a process pool and a full rebuild uses every core
+# Every parse function is a plain module function taking the page bytes, so it can be sent to a worker,
+# and returns tuples of epoch seconds or a string, which are cheap to send back
+
+import datetime
+import multiprocessing
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from json import loads
+
+import pandas as pd
+import pytz
+from bs4 import BeautifulSoup
+from dateutil import parser
+
+EASTERN_TZ = pytz.timezone('US/Eastern')
+# Name of the JSON object holding the earnings table in the Zacks earnings announcements page
+EARNINGS_TABLE_KEY = "earnings_announcements_earnings_table"
+
+
+# Class to parse the date strings found on Zacks pages
+# Known formats are parsed a whole column at a time, recently seen strings are remembered,
+# and only strings in no known format go through the slow fuzzy parser
+class DateParser:
+    # (pattern, strptime format) pairs for the formats Zacks uses
+    _FORMATS = [
+        (re.compile(r'^\d{1,2}/\d{1,2}/\d{4}$'), '%m/%d/%Y'),
+        (re.compile(r'^\d{1,2}/\d{1,2}/\d{2}$'), '%m/%d/%y'),
+        (re.compile(r'^\d{4}-\d{2}-\d{2}$'), '%Y-%m-%d'),
+    ]
+    # Next report dates carry a timing note such as "4/28/2022 *AMC"
+    _TRAILING_NOTE = re.compile(r'\s*\*.*$')
+
+    def __init__(self, timezone, memo_size=4096):
+        self._timezone = timezone
+        self._memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, string):
+        return self.parse_all([string])[0]
+
+    # Timezone aware dates for a list of strings, in the same order
+    def parse_all(self, strings):
+        results = [None] * len(strings)
+        # index lists of strings not in the memo, grouped by detected format
+        by_format = {}
+        with self._lock:
+            for index, string in enumerate(strings):
+                if string in self._memo:
+                    self._memo.move_to_end(string)
+                    results[index] = self._memo[string]
+                else:
+                    by_format.setdefault(self._detect(string), []).append(index)
+
+        parsed = {}
+        for date_format, indexes in by_format.items():
+            if date_format is None:
+                continue
+            column = pd.Series([self._clean(strings[_]) for _ in indexes])
+            dates = pd.to_datetime(column, format=date_format, errors='coerce').dt.tz_localize(self._timezone)
+            for index, date in zip(indexes, dates):
+                if not pd.isnull(date):
+                    parsed[index] = date
+
+        # Anything the known formats could not handle gets the fuzzy parser
+        for indexes in by_format.values():
+            for index in indexes:
+                if index not in parsed:
+                    parsed[index] = self._timezone.localize(parser.parse(strings[index], fuzzy=True))
+
+        with self._lock:
+            for index, date in parsed.items():
+                results[index] = date
+                self._memo[strings[index]] = date
+            while len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        return results
+
+    def _clean(self, string):
+        return self._TRAILING_NOTE.sub('', str(string).strip())
+
+    def _detect(self, string):
+        string = self._clean(string)
+        for pattern, date_format in self._FORMATS:
+            if pattern.match(string):
+                return date_format
+        return None
+
+
+_date_parser = None
+
+
+# One date parser per process, so its memo is reused by every page the process parses
+def _dates():
+    global _date_parser
+    if _date_parser is None:
+        _date_parser = DateParser(EASTERN_TZ)
+    return _date_parser
+
+
+# Earnings announcement dates of a Zacks earnings page as epoch seconds, None if the page has no table
+# Reports after the close count from the next day, that is when the price moves on them
+def earnings_times(content):
+    table = earnings_table(content)
+    if table is None:
+        return None
+    dates = _dates().parse_all([_[0] for _ in table])
+    return tuple(int((date + datetime.timedelta(days=1) if row[6] == "After Close" else date).timestamp())
+                 for date, row in zip(dates, table))
+
+
+# Rows of the earnings table JSON embedded in the page, None if the page has none
+# Tries a byte search first and only builds a DOM when that fails
+def earnings_table(content):
+    table = earnings_table_fast(content)
+    if table is None:
+        table = earnings_table_dom(content)
+    return table
+
+
+# Find the table key in the raw page and cut its <script> body out directly
+def earnings_table_fast(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    index = content.find(EARNINGS_TABLE_KEY.encode())
+    if index < 0:
+        return None
+    # The key has to sit inside a script tag: <script ...> ... key ... </script>
+    start = content.rfind(b'<script', 0, index)
+    end = content.find(b'</script>', index)
+    if start < 0 or end < 0 or content.find(b'</script>', start, index) >= 0:
+        return None
+    js = content[content.find(b'>', start) + 1:end]
+    try:
+        return loads(js[js.find(b'{'): js.rfind(b'}') + 1])[EARNINGS_TABLE_KEY]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def earnings_table_dom(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    scripts = soup.find_all('script')
+    table_scripts = [_ for _ in scripts if _.string and EARNINGS_TABLE_KEY in _.string]
+    if len(table_scripts) > 0:
+        js = table_scripts[0].string
+        obj = loads(js[js.find('{'): js.rfind('}') + 1])
+        return obj[EARNINGS_TABLE_KEY]
+
+
+# Next report date of a Zacks detailed estimates page as epoch seconds, () if the page has none
+def next_earnings_times(content):
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        tables = pd.read_html(StringIO(content), match="Next Report Date", index_col=0, parse_dates=True)
+        if len(tables) == 0:
+            return ()
+        date_string = tables[0].loc['Next Report Date'].values[0]
+        # Known formats are parsed directly, anything else falls back to the fuzzy parser
+        return int(_dates().parse(date_string).timestamp()),
+    except Exception:
+        return ()
+
+
+# Company description of a MarketWatch page, '' if it has none
+def company_detail(content):
+    details = BeautifulSoup(content, 'html.parser').find_all(class_='description__text')
+    if len(details) > 0:
+        return details[0].text
+    return ''
+
+
+# Epoch seconds back to timezone aware Timestamps, as the date parser returns them
+def to_dates(times, timezone=EASTERN_TZ):
+    return list(pd.to_datetime(list(times), unit='s', utc=True).tz_convert(timezone))
+
+
+# Process pool for the parse functions above
+# With no worker processes (single core machines) pages are parsed on the calling thread
+class ParsePool:
+    # processes defaults to one per core, less the one the GUI and the fetcher threads run on
+    def __init__(self, processes=None):
+        self._processes = max(0, (os.cpu_count() or 1) - 1) if processes is None else processes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # concurrent.futures.Future of function(content)
+    def submit(self, function, content):
+        if self._processes == 0:
+            future = Future()
+            try:
+                future.set_result(function(content))
+            except Exception as error:
+                future.set_exception(error)
+            return future
+        try:
+            return self._start().submit(function, content)
+        except BrokenProcessPool:
+            # A worker died, start a new pool for this and later pages
+            with self._lock:
+                self._executor = None
+            return self._start().submit(function, content)
+
+    def run(self, function, content):
+        return self.submit(function, content).result()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers are spawned, a fork would copy the fetcher's event loop threads and locks mid use
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+
+_shared_pool = None
+_shared_lock = threading.Lock()
+
+
+# Parse pool shared by scrape.py and api.py
+def shared_pool():
+    global _shared_pool
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = ParsePool()
+        return _shared_pool
@@ -0,0 +1,146 @@
+# This Quotes file serves current prices from the Zacks quote feed to every view
+# Symbols are split into batches short enough for one URL each and the batches are fetched at once,
+# a failed batch is tried again without refetching the rest,
+# and prices are cached for a short time: a price past its time to live is still returned
+# while a new one is fetched in the background
+
+import threading
+import time
+from json import loads
+
+import fetch
+import metrics
+
+
+# Shared cache of last prices in front of the quote feed
+class QuoteService:
+    _BASE_URL = "http://quote-feed.zacks.com/?t=%s"
+    # Use request header as best practice
+    _REQUEST_HEADER = {
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.75 "
+                      "Safari/537.36",
+        "X-Requested-With": "XMLHttpRequest"
+    }
+    # Longest URL sent, well under what servers and proxies accept
+    MAX_URL_LENGTH = 2000
+    # Extra tries for batches that failed, and seconds to wait before each one
+    RETRIES = 2
+    RETRY_DELAY = 0.5
+
+    # ttl: seconds a price is served as is
+    # max_stale: seconds after that it is still served while being refreshed, older prices are fetched first
+    def __init__(self, fetcher=None, ttl=60, max_stale=15 * 60, timeout=10):
+        self._fetcher = fetcher or fetch.shared_fetcher()
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._timeout = timeout
+        # symbol -> (price, time it was fetched)
+        self._prices = {}
+        self._revalidating = set()
+        self._lock = threading.Lock()
+
+    # Last price of each symbol, '' if there is none
+    # With wait=False the caller never waits for the feed: missing prices are fetched in the background
+    # like stale ones and come back as '' this time
+    # on_fetched(symbols) is called from the background thread with the symbols it got new prices for
+    def prices(self, symbols, wait=True, on_fetched=None):
+        symbols = list(dict.fromkeys(symbols))
+        now = time.monotonic()
+        missing, stale = [], []
+        with self._lock:
+            for symbol in symbols:
+                cached = self._prices.get(symbol)
+                if cached is None or now - cached[1] > self._ttl + self._max_stale:
+                    missing.append(symbol)
+                elif now - cached[1] > self._ttl:
+                    stale.append(symbol)
+            # Symbols another thread is already fetching are left to it
+            background = [_ for _ in (stale if wait else stale + missing) if _ not in self._revalidating]
+            self._revalidating.update(background)
+
+        recorder = metrics.shared_metrics()
+        recorder.cache('quotes', 'miss', len(missing))
+        recorder.cache('quotes', 'stale', len(stale))
+        recorder.cache('quotes', 'hit', len(symbols) - len(missing) - len(stale))
+        if len(background) > 0:
+            threading.Thread(target=self._revalidate, args=(background, on_fetched), daemon=True).start()
+        if wait and len(missing) > 0:
+            self.refresh(missing)
+        return self.cached(symbols)
+
+    # Last price of each symbol as cached, '' if there is none, never asks the feed
+    def cached(self, symbols):
+        with self._lock:
+            return {symbol: self._prices[symbol][0] if symbol in self._prices else '' for symbol in symbols}
+
+    # Fetch the prices of symbols now, returns the symbols that could not be fetched
+    def refresh(self, symbols):
+        pending = self._batches(list(dict.fromkeys(symbols)))
+        for attempt in range(1 + self.RETRIES):
+            if len(pending) == 0:
+                break
+            if attempt > 0:
+                time.sleep(self.RETRY_DELAY * attempt)
+            pages = self._fetcher.fetch_all(list(pending), headers=self._REQUEST_HEADER, timeout=self._timeout)
+            failed = {}
+            for url, batch in pending.items():
+                prices = self._parse(pages.get(url))
+                if prices is None:
+                    failed[url] = batch
+                    continue
+                # Symbols the feed doesn't know are cached as '' too, so they aren't asked for on every call
+                self._store({**{symbol: '' for symbol in batch}, **prices})
+            pending = failed
+        return [symbol for batch in pending.values() for symbol in batch]
+
+    def _revalidate(self, symbols, on_fetched=None):
+        try:
+            failed = set(self.refresh(symbols))
+        finally:
+            with self._lock:
+                self._revalidating.difference_update(symbols)
+        fetched = [_ for _ in symbols if _ not in failed]
+        if on_fetched and len(fetched) > 0:
+            on_fetched(fetched)
+
+    # {url: symbols} with every url at most MAX_URL_LENGTH long
+    def _batches(self, symbols):
+        batches = {}
+        batch = []
+        for symbol in symbols:
+            if batch and len(self._BASE_URL % ",".join(batch + [symbol])) > self.MAX_URL_LENGTH:
+                batches[self._BASE_URL % ",".join(batch)] = batch
+                batch = []
+            batch.append(symbol)
+        if batch:
+            batches[self._BASE_URL % ",".join(batch)] = batch
+        return batches
+
+    # {symbol: last price} from a quote feed response, None if the request failed
+    def _parse(self, body):
+        if body is None:
+            return None
+        try:
+            quotes = loads(body)
+            return {symbol: quotes[symbol].get('last', '') for symbol in quotes}
+        except (ValueError, AttributeError, TypeError):
+            return None
+
+    def _store(self, prices):
+        now = time.monotonic()
+        with self._lock:
+            for symbol, price in prices.items():
+                self._prices[symbol] = (price, now)
+
+
+_shared_service = None
+_shared_lock = threading.Lock()
+
+
+# Quote service every view reads prices from
+def shared_service():
+    global _shared_service
+    with _shared_lock:
+        if _shared_service is None:
+            _shared_service = QuoteService()
+        return _shared_service
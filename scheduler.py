@@ -0,0 +1,233 @@
+# This Scheduler file runs the refresh pipeline as a graph of small per symbol tasks instead of stage after stage
+# A task starts as soon as the tasks it needs have finished, on the worker pool of the site it talks to,
+# so one symbol's prices can be downloaded while other symbols' earnings pages are still coming in
+# and a slow site only holds up the tasks that wait on it
+# Batcher groups single requests into the batched downloads a source wants, such as multi ticker price downloads
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from tqdm import tqdm
+
+import metrics
+
+
+class _Task:
+    def __init__(self, key, function, after, pool, stage, symbol):
+        self.key = key
+        self.function = function
+        self.after = tuple(after)
+        self.pool = pool
+        self.stage = stage
+        self.symbol = symbol
+
+
+# Graph of tasks keyed by any hashable, usually (stage, symbol)
+class TaskGraph:
+    # pools maps pool name -> worker threads, timeout is seconds for the whole run
+    def __init__(self, pools, timeout=None):
+        self._pools = pools
+        self._timeout = timeout
+        self._tasks = {}
+
+    # function(*results of the after tasks) runs on the pool named pool,
+    # or on the thread calling run() when pool is None, which is where shared data should be changed
+    # A function may return a concurrent.futures.Future, the task then finishes with that future
+    # Failures are recorded in metrics.py under stage and symbol, and the tasks after a failed one are skipped
+    def add(self, key, function, after=(), pool=None, stage=None, symbol=None):
+        if key in self._tasks:
+            raise ValueError(f"Task {key!r} was added twice")
+        self._tasks[key] = _Task(key, function, after, pool, stage, symbol)
+        return key
+
+    def __len__(self):
+        return len(self._tasks)
+
+    # Run every task and return {key: result} of the ones that finished
+    # Tasks still waiting or running at the timeout are recorded as timed out and their results dropped
+    def run(self):
+        missing = [_ for task in self._tasks.values() for _ in task.after if _ not in self._tasks]
+        if len(missing) > 0:
+            raise KeyError(f"Tasks {missing!r} are needed but were never added")
+
+        recorder = metrics.shared_metrics()
+        stages = {task.stage for task in self._tasks.values() if task.stage}
+        for stage in stages:
+            recorder.clear_failures(stage)
+
+        waiting = {key: len(task.after) for key, task in self._tasks.items()}
+        dependents = {key: [] for key in self._tasks}
+        for key, task in self._tasks.items():
+            for before in task.after:
+                dependents[before].append(key)
+
+        executors = {name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+                     for name, workers in self._pools.items()}
+        # (key, result, error) of tasks as they finish, from any thread
+        finished = queue.Queue()
+        results = {}
+        done = set()
+        # stage -> [first start, last finish] in perf_counter seconds
+        spans = {}
+        ready = deque(key for key, count in waiting.items() if count == 0)
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        progress_bar = tqdm(total=len(self._tasks))
+
+        def settle(key, future):
+            if future.cancelled():
+                finished.put((key, None, 'cancelled'))
+                return
+            error = future.exception()
+            if error is not None:
+                finished.put((key, None, error))
+                return
+            result = future.result()
+            if isinstance(result, Future):
+                result.add_done_callback(lambda _: settle(key, _))
+            else:
+                finished.put((key, result, None))
+
+        def start(key):
+            task = self._tasks[key]
+            if task.stage:
+                spans.setdefault(task.stage, [time.perf_counter(), None])
+            args = [results[_] for _ in task.after]
+            if task.pool is None:
+                future = Future()
+                try:
+                    future.set_result(task.function(*args))
+                except Exception as error:
+                    future.set_exception(error)
+            else:
+                future = executors[task.pool].submit(task.function, *args)
+            future.add_done_callback(lambda _: settle(key, _))
+
+        # Mark a task and everything after it as done without running them
+        def skip(key):
+            stack = [key]
+            while stack:
+                for dependent in dependents[stack.pop()]:
+                    if dependent not in done:
+                        done.add(dependent)
+                        progress_bar.update()
+                        stack.append(dependent)
+
+        try:
+            while len(done) < len(self._tasks):
+                while ready:
+                    start(ready.popleft())
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    key, result, error = finished.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                task = self._tasks[key]
+                done.add(key)
+                progress_bar.set_description(str(task.symbol or task.stage or ''))
+                progress_bar.update()
+                if task.stage:
+                    spans[task.stage][1] = time.perf_counter()
+                if error is not None:
+                    if task.symbol is not None:
+                        recorder.failed(task.symbol, f'error: {error}', stage=task.stage)
+                    skip(key)
+                    continue
+                results[key] = result
+                for dependent in dependents[key]:
+                    waiting[dependent] -= 1
+                    # A dependent may already be skipped because another task it needs failed
+                    if waiting[dependent] == 0 and dependent not in done:
+                        ready.append(dependent)
+
+            # Whatever didn't get to finish ran out of time
+            for key, task in self._tasks.items():
+                if key not in done and task.symbol is not None:
+                    recorder.failed(task.symbol, 'timeout', stage=task.stage)
+        finally:
+            progress_bar.close()
+            for executor in executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        # Stages overlap, so each one is timed from its first task starting to its last task finishing
+        for stage, (first, last) in spans.items():
+            recorder.add_stage_run(stage, (last or time.perf_counter()) - first)
+        return results
+
+
+# Collects single requests and runs them in batches: a batch starts once it has size requests
+# or linger seconds after its first request, whichever comes first
+# While every worker is busy a lingering batch keeps filling instead, and starts when a worker is free
+# run_batch({key: value}) returns {key: result}, keys it leaves out get None
+class Batcher:
+    def __init__(self, run_batch, size=100, linger=0.5, workers=1):
+        self._run_batch = run_batch
+        self._size = size
+        self._linger = linger
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+        # key -> (value, future) waiting for the next batch
+        self._pending = {}
+        self._timer = None
+        # Batches started and not finished yet
+        self._running = 0
+        # The linger time ran out while the workers were busy, the next free worker takes the batch
+        self._lingered = False
+        self._lock = threading.Lock()
+
+    # Future of the result for one key
+    def submit(self, key, value):
+        future = Future()
+        with self._lock:
+            self._pending[key] = (value, future)
+            if len(self._pending) >= self._size:
+                self._flush()
+            elif self._timer is None and not self._lingered:
+                self._timer = threading.Timer(self._linger, self._linger_over)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    # Start a batch with whatever is waiting now
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    # A batch started now would only queue behind the running ones, so it waits for a worker and keeps filling
+    def _linger_over(self):
+        with self._lock:
+            self._timer = None
+            if self._running >= self._workers:
+                self._lingered = True
+            else:
+                self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._lingered = False
+        if len(self._pending) == 0:
+            return
+        batch, self._pending = self._pending, {}
+        self._running += 1
+        self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            results = self._run_batch({key: value for key, (value, _) in batch.items()})
+        except Exception as error:
+            for _, future in batch.values():
+                future.set_exception(error)
+            return
+        finally:
+            with self._lock:
+                self._running -= 1
+                if self._lingered:
+                    self._flush()
+        for key, (_, future) in batch.items():
+            future.set_result(results.get(key))
@@ -0,0 +1,134 @@
+# This Search file indexes company symbols and names for the search box in gui.py
+# Symbols, full names and the words of each name are kept in sorted lists,
+# so a prefix lookup is a bisect plus a walk over the matches instead of a scan of every row
+# Misspelled queries fall back to fuzzy matching with difflib
+
+import bisect
+import difflib
+import re
+import threading
+
+
+# Prefix and fuzzy search over {'symbol', 'name'} companies
+# update() applies constituent changes without rebuilding the whole index
+class SearchIndex:
+    # Lowest similarity (0 to 1) for a fuzzy match
+    FUZZY_CUTOFF = 0.75
+
+    def __init__(self, companies=()):
+        self._names = {}
+        # Sorted (key, symbol) pairs, keys are lowercase
+        self._symbol_keys = []
+        self._name_keys = []
+        self._token_keys = []
+        # Fuzzy match candidates, {lowercase symbol or name word: [symbols]}, built when first needed
+        self._vocabulary = None
+        self._lock = threading.Lock()
+        self.update(companies)
+
+    # Bring the index in line with the current company list, only touching what changed
+    def update(self, companies):
+        names = {_['symbol']: _['name'] for _ in companies}
+        with self._lock:
+            for symbol in [_ for _ in self._names if names.get(_) != self._names[_]]:
+                self._remove(symbol)
+            for symbol, name in names.items():
+                if symbol not in self._names:
+                    self._add(symbol, name)
+
+    def add(self, symbol, name):
+        with self._lock:
+            self._remove(symbol)
+            self._add(symbol, name)
+
+    def remove(self, symbol):
+        with self._lock:
+            self._remove(symbol)
+
+    def __len__(self):
+        return len(self._names)
+
+    # Symbols matching query, best first: exact symbol, symbol prefix, name prefix,
+    # every query word starting a word of the name, then fuzzy matches if there are fewer than limit
+    def search(self, query, limit=None):
+        query = query.strip().lower()
+        if query == "":
+            return []
+        with self._lock:
+            results = {}
+            for symbol in self._prefixed(self._symbol_keys, query, sort_key=len):
+                results[symbol] = None
+            for symbol in self._prefixed(self._name_keys, query):
+                results[symbol] = None
+            for symbol in self._token_matches(query):
+                results[symbol] = None
+            if limit is None or len(results) < limit:
+                for symbol in self._fuzzy(query):
+                    results[symbol] = None
+        results = list(results)
+        return results if limit is None else results[:limit]
+
+    def name(self, symbol):
+        return self._names.get(symbol)
+
+    def _add(self, symbol, name):
+        self._vocabulary = None
+        self._names[symbol] = name
+        bisect.insort(self._symbol_keys, (symbol.lower(), symbol))
+        bisect.insort(self._name_keys, (name.lower(), symbol))
+        for token in self._tokens(name):
+            bisect.insort(self._token_keys, (token, symbol))
+
+    def _remove(self, symbol):
+        name = self._names.pop(symbol, None)
+        if name is None:
+            return
+        self._vocabulary = None
+        self._discard(self._symbol_keys, (symbol.lower(), symbol))
+        self._discard(self._name_keys, (name.lower(), symbol))
+        for token in self._tokens(name):
+            self._discard(self._token_keys, (token, symbol))
+
+    def _discard(self, keys, key):
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+    # Symbols whose key starts with prefix, in key order or by sort_key of the key
+    def _prefixed(self, keys, prefix, sort_key=None):
+        matches = []
+        for index in range(bisect.bisect_left(keys, (prefix,)), len(keys)):
+            key, symbol = keys[index]
+            if not key.startswith(prefix):
+                break
+            matches.append((key, symbol))
+        if sort_key is not None:
+            matches.sort(key=lambda _: sort_key(_[0]))
+        return [_[1] for _ in matches]
+
+    # Names where every query word starts one of the name's words, in symbol order
+    def _token_matches(self, query):
+        words = self._tokens(query)
+        if len(words) == 0:
+            return []
+        matches = None
+        for word in words:
+            symbols = set(self._prefixed(self._token_keys, word))
+            matches = symbols if matches is None else matches & symbols
+        return sorted(matches)
+
+    # Symbols or name words close to the query, for typos
+    def _fuzzy(self, query):
+        if self._vocabulary is None:
+            self._vocabulary = {}
+            for key, symbol in self._symbol_keys + self._token_keys:
+                self._vocabulary.setdefault(key, []).append(symbol)
+        matches = []
+        for word in self._tokens(query) or [query]:
+            for key in difflib.get_close_matches(word, list(self._vocabulary), n=10, cutoff=self.FUZZY_CUTOFF):
+                matches.extend(self._vocabulary[key])
+        return matches
+
+    # Lowercase words of a name, without punctuation
+    def _tokens(self, text):
+        return list(dict.fromkeys(re.findall(r"[a-z0-9&]+", text.lower())))
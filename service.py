@@ -0,0 +1,223 @@
+# This Service file runs the data pipeline without the GUI
+# One warm process keeps the data in memory, refreshes it on a schedule and answers JSON requests,
+# so clients don't each rebuild the data:
+#     python service.py refresh                         run the refresh pipeline once and exit
+#     python service.py refresh --metrics metrics.json  and write where its time went to a file
+#     python service.py show TSLA                       print one company's data as JSON
+#     python service.py serve --port 8500 --interval 3600
+# Endpoints of serve (all GET, JSON):
+#     /health                      last refresh times and company count
+#     /companies                   [{symbol, name}]
+#     /companies/TSLA              everything below in one object
+#     /companies/TSLA/averages     earnings_averages
+#     /companies/TSLA/earnings     earnings_change, one object per report
+#     /companies/TSLA/next         stored next earnings date
+#     /companies/TSLA/detail       company_detail
+#     /metrics                     stage times, requests, cache hit rates and failures in the Prometheus text format
+#     /metrics.json                the same as JSON, with the symbols each stage failed on
+
+import argparse
+import datetime
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import metrics
+from api import CompanyInfo
+
+
+# JSON views of the CompanyInfo data, all read from memory
+class CompanyService:
+    PARTS = ('averages', 'earnings', 'next', 'detail')
+
+    def __init__(self, company_info):
+        self.company_info = company_info
+        self.started_at = datetime.datetime.now().isoformat()
+        self.last_refresh_start = None
+        self.last_refresh_end = None
+        self.refreshing = False
+
+    def health(self):
+        return {
+            'companies': len(self.company_info.companies),
+            'started_at': self.started_at,
+            'refreshing': self.refreshing,
+            'last_refresh_start': self.last_refresh_start,
+            'last_refresh_end': self.last_refresh_end,
+        }
+
+    def companies(self):
+        return [{'symbol': _['symbol'], 'name': _['name']} for _ in self.company_info.companies]
+
+    # True if company(symbol, part) has something to answer, even if that is null
+    def knows(self, symbol, part=None):
+        return symbol.upper() in self.company_info.sp_dict and (part is None or part in self.PARTS)
+
+    # None if the symbol isn't known
+    def company(self, symbol, part=None):
+        symbol = symbol.upper()
+        info = self.company_info
+        if symbol not in info.sp_dict:
+            return None
+        parts = {
+            'averages': lambda: info.earnings_averages(symbol),
+            'earnings': lambda: self._earnings(symbol),
+            'next': lambda: self._next(symbol),
+            'detail': lambda: info.company_detail(symbol),
+        }
+        if part is None:
+            return {'symbol': symbol, 'name': info.company_name(symbol),
+                    **{name: self._read(value) for name, value in parts.items()}}
+        if part not in parts:
+            return None
+        return self._read(parts[part])
+
+    # New companies have no table or detail until the refresh reaches them
+    def _read(self, value):
+        try:
+            return value()
+        except KeyError:
+            return None
+
+    # A passed or missing date is stale and shows as null, not as the 2050-01-01 placeholder the GUI sorts last
+    def _next(self, symbol):
+        if self.company_info.stale_next_earnings([symbol]):
+            return None
+        return self.company_info.cached_next_earnings_date(symbol)
+
+    def _earnings(self, symbol):
+        rows = self.company_info.earnings_change(symbol)
+        return [{'date': date, 'close_pre': close_pre, 'close_post': close_post, 'percent_change': percent_change}
+                for date, close_pre, close_post, percent_change in rows or []]
+
+    # Run the full refresh pipeline now and wait for it, raising what it failed with
+    def refresh(self):
+        self.refreshing = True
+        self.last_refresh_start = datetime.datetime.now().isoformat()
+        try:
+            thread = self.company_info.refresh_in_background()
+            thread.join()
+            if thread.error is not None:
+                raise thread.error
+        finally:
+            self.refreshing = False
+            self.last_refresh_end = datetime.datetime.now().isoformat()
+
+    # Refresh every interval seconds until stop is set, starting now
+    def refresh_every(self, interval, stop):
+        while not stop.is_set():
+            try:
+                self.refresh()
+            except Exception as error:
+                print(f"Refresh failed: {error}")
+            stop.wait(interval)
+
+
+# Request handler, one thread per connection
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        parts = [_ for _ in urlsplit(self.path).path.split('/') if _]
+        try:
+            if parts == ['health']:
+                return self._send(200, self.service.health())
+            if parts == ['companies']:
+                return self._send(200, self.service.companies())
+            if parts == ['metrics']:
+                return self._send_text(200, metrics.shared_metrics().to_prometheus(), 'text/plain; version=0.0.4')
+            if parts == ['metrics.json']:
+                return self._send(200, metrics.shared_metrics().snapshot())
+            if len(parts) in (2, 3) and parts[0] == 'companies':
+                part = parts[2] if len(parts) == 3 else None
+                # A known company answers null for data it doesn't have yet, such as a stale next date
+                if self.service.knows(parts[1], part):
+                    return self._send(200, self.service.company(parts[1], part))
+        except Exception as error:
+            return self._send(500, {'error': str(error)})
+        self._send(404, {'error': 'not found'})
+
+    def _send(self, status, value):
+        self._send_text(status, to_json(value), 'application/json')
+
+    def _send_text(self, status, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are many and small, keep the console for refresh progress
+    def log_message(self, format, *args):
+        pass
+
+
+# JSON with dates as ISO strings and NaN as null
+def to_json(value):
+    return json.dumps(_plain(value))
+
+
+def _plain(value):
+    if isinstance(value, dict):
+        return {str(key): _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(_) for _ in value]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        # NumPy scalars
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def serve(host, port, interval):
+    service = CompanyService(CompanyInfo(lazy=True))
+    stop = threading.Event()
+    threading.Thread(target=service.refresh_every, args=(interval, stop), daemon=True).start()
+
+    ServiceRequestHandler.service = service
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    print(f"Serving {len(service.company_info.companies)} companies on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Run the S&P 500 earnings data pipeline without the GUI")
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    refresh_command = commands.add_parser('refresh', help="run the refresh pipeline once and save the data")
+    refresh_command.add_argument('--metrics', metavar='FILE', help="write the refresh metrics to FILE as JSON")
+
+    show = commands.add_parser('show', help="print the stored data of companies as JSON")
+    show.add_argument('symbols', nargs='+')
+
+    serve_command = commands.add_parser('serve', help="serve the data as JSON and refresh it on a schedule")
+    serve_command.add_argument('--host', default='127.0.0.1')
+    serve_command.add_argument('--port', type=int, default=8500)
+    serve_command.add_argument('--interval', type=int, default=60 * 60, help="seconds between refreshes")
+
+    args = arg_parser.parse_args()
+    if args.command == 'refresh':
+        start = time.perf_counter()
+        CompanyService(CompanyInfo(lazy=True)).refresh()
+        print(f"\n\nRefresh finished in {time.perf_counter() - start:.1f}s")
+        if args.metrics:
+            with open(args.metrics, 'w') as file:
+                file.write(metrics.shared_metrics().to_json(indent=2))
+    elif args.command == 'show':
+        service = CompanyService(CompanyInfo(lazy=True))
+        print(json.dumps({_: _plain(service.company(_)) for _ in args.symbols}, indent=2))
+    elif args.command == 'serve':
+        serve(args.host, args.port, args.interval)
@@ -0,0 +1,83 @@
+# This Stats file precomputes earnings reaction statistics for every symbol at once
+# api.py runs it after each refresh and keeps the results as plain dicts keyed by symbol and window,
+# so the GUI and exports read them without touching the per-symbol earnings tables
+
+import numpy as np
+import pandas as pd
+
+
+# Statistics of the price change 1 market day after earnings, over the n most recent reports
+class EarningsStats:
+    # Report windows computed by default
+    WINDOWS = (4, 8, 10)
+    # Percentiles of the absolute percent change
+    _PERCENTILES = (0.25, 0.75, 0.9)
+
+    # tables maps symbol -> earnings table (most recent report first, an arrays.EarningsView or DataFrame)
+    # implied_moves optionally maps symbol -> expected absolute percent move priced in by options
+    # Returns {symbol: {n: {metric: value}}}
+    def compute(self, tables, windows=None, implied_moves=None):
+        windows = self.WINDOWS if windows is None else windows
+        events = self._events(tables)
+        stats = {symbol: {} for symbol in tables}
+        if len(events) == 0:
+            return stats
+
+        if implied_moves:
+            events['implied'] = events['symbol'].map(implied_moves).astype(float)
+            events['beat_implied'] = (events['abs_percent'] > events['implied']).astype(float)
+            events.loc[events['implied'].isna(), 'beat_implied'] = np.nan
+
+        for n in windows:
+            # Rank is the position in the table, so missing prices still use up a slot like avg_price
+            window = events[events['rank'] < n].dropna(subset=['percent'])
+            grouped = window.groupby('symbol')
+            summary = grouped.agg(
+                count=('percent', 'count'),
+                point_mean=('abs_point', 'mean'),
+                point_median=('abs_point', 'median'),
+                point_std=('abs_point', 'std'),
+                percent_mean=('abs_percent', 'mean'),
+                percent_median=('abs_percent', 'median'),
+                percent_std=('abs_percent', 'std'),
+                percent_max=('abs_percent', 'max'),
+                up_rate=('up', 'mean'),
+                down_rate=('down', 'mean'),
+            )
+            # Windows without any prices have no quantiles at all, so their percentiles come back as NaN
+            percentiles = grouped['abs_percent'].quantile(list(self._PERCENTILES)).unstack().reindex(
+                index=summary.index, columns=list(self._PERCENTILES))
+            for percentile in self._PERCENTILES:
+                summary['percent_p%d' % round(percentile * 100)] = percentiles[percentile]
+
+            if implied_moves:
+                implied = pd.Series(implied_moves, dtype=float)
+                summary['implied_move'] = implied.reindex(summary.index)
+                summary['mean_to_implied'] = summary['percent_mean'] / summary['implied_move']
+                summary['beat_implied_rate'] = grouped['beat_implied'].mean()
+
+            for symbol, row in summary.to_dict('index').items():
+                stats[symbol][n] = row
+        return stats
+
+    # One row per report for every symbol: symbol, rank, point and percent change
+    def _events(self, tables):
+        frames = []
+        for symbol, table in tables.items():
+            if table is None or len(table) == 0:
+                continue
+            frames.append(pd.DataFrame({
+                'symbol': symbol,
+                'rank': np.arange(len(table)),
+                'point': np.asarray(pd.to_numeric(table['Point_Change'], errors='coerce'), dtype=float),
+                'percent': np.asarray(pd.to_numeric(table['Percent_Change'], errors='coerce'), dtype=float),
+            }))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['symbol', 'rank', 'point', 'percent'])
+
+        events = pd.concat(frames, ignore_index=True)
+        events['abs_point'] = events['point'].abs()
+        events['abs_percent'] = events['percent'].abs()
+        events['up'] = (events['percent'] > 0).astype(float)
+        events['down'] = (events['percent'] < 0).astype(float)
+        return events
@@ -0,0 +1,339 @@
+# This Store file keeps the S&P data dict on disk for api.py
+# It replaces the single sp_dict.pickle with a SQLite database,
+# so a refresh of one symbol only writes that symbol's rows
+# and startup can read only the columns it needs
+# Earnings tables are also kept in a memory mapped snapshot (see arrays.py) next to the database,
+# used at startup as long as no earnings rows have changed since it was written
+
+import pickle
+import sqlite3
+import threading
+import time
+from os.path import exists, splitext
+
+import pandas as pd
+import pytz
+
+import arrays
+
+
+# Class to read and write the data dict used by SPData and CompanyInfo
+# One row per company and one row per (symbol, earnings date)
+class SPStore:
+    _EASTERN_TZ = pytz.timezone('US/Eastern')
+    # Old single file storage, imported once if the database is new
+    _PICKLE_PATH = 'sp_dict.pickle'
+    # Columns of the earnings table kept for each symbol
+    _TABLE_COLUMNS = ['Date', 'Close_Pre', 'Close_Post', 'Point_Change', 'Percent_Change']
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS companies (
+            symbol TEXT PRIMARY KEY,
+            name TEXT,
+            next_earnings TEXT,
+            pending_earnings TEXT,
+            detail TEXT,
+            point_avg REAL,
+            percent_avg REAL,
+            saved_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS earnings (
+            symbol TEXT NOT NULL,
+            date TEXT NOT NULL,
+            close_pre REAL,
+            close_post REAL,
+            point_change REAL,
+            percent_change REAL,
+            PRIMARY KEY (symbol, date)
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            symbol TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL,
+            PRIMARY KEY (symbol, n, metric)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('earnings_version', 0);
+    """
+
+    def __init__(self, path='sp_data.db'):
+        is_new = not exists(path)
+        self.snapshot_path = splitext(path)[0] + '.snap'
+        # Connection is shared by the GUI and refresh threads, so guard it with a lock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(self._SCHEMA)
+        # symbol -> the table object whose rows are in the database
+        # SPData replaces a table when it changes instead of changing it in place,
+        # so a symbol saved again with the same table has no earnings rows to write
+        self._saved_tables = {}
+        # Databases written before company names were stored
+        columns = [_[1] for _ in self._db.execute("PRAGMA table_info(companies)")]
+        for column in ('name', 'saved_at', 'pending_earnings'):
+            if column not in columns:
+                self._db.execute("ALTER TABLE companies ADD COLUMN %s TEXT" % column)
+        if is_new and exists(self._PICKLE_PATH):
+            self.save(pickle.load(open(self._PICKLE_PATH, 'rb')))
+
+    # Whole data dict in the shape SPData uses: {symbol: {'next_earnings', 'pending_earnings', 'table', 'avg', 'detail'}}
+    # Tables are arrays.EarningsView slices of one arrays.EarningsArrays holding every stored event
+    # Companies that only have a name stored have no data yet and are left out
+    # This is also the startup read of the home view: the earnings tables are mapped from the snapshot,
+    # not read, so only the per company columns are actually loaded before the first window
+    def load(self):
+        with self._lock:
+            companies = self._db.execute(
+                "SELECT symbol, next_earnings, pending_earnings, detail, point_avg, percent_avg FROM companies "
+                "WHERE saved_at IS NOT NULL").fetchall()
+            version = self._earnings_version()
+            earnings = self._open_snapshot(version)
+            if earnings is None:
+                rows = self._db.execute(
+                    "SELECT symbol, date, close_pre, close_post, percent_change, point_change FROM earnings "
+                    "ORDER BY symbol, date DESC").fetchall()
+
+        if earnings is None:
+            # Columns are selected in arrays.FIELDS order
+            earnings = arrays.EarningsArrays.from_rows(rows)
+            self._write_snapshot(earnings, version)
+
+        sp_dict = {}
+        for symbol, next_earnings, pending_earnings, detail, point_avg, percent_avg in companies:
+            sp_dict[symbol] = {
+                'next_earnings': self._to_dates(next_earnings),
+                'pending_earnings': self._to_dates(pending_earnings),
+                'table': earnings.view(symbol),
+                'avg': {'point_avg': self._nan(point_avg), 'percent_avg': self._nan(percent_avg)},
+            }
+            if detail is not None:
+                sp_dict[symbol]['detail'] = detail
+        with self._lock:
+            self._saved_tables = {symbol: info['table'] for symbol, info in sp_dict.items()}
+        return sp_dict
+
+    # Last stored S&P 500 company list, [{'symbol', 'name'}] in symbol order
+    def load_companies(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT symbol, name FROM companies WHERE name IS NOT NULL ORDER BY symbol").fetchall()
+        return [{'symbol': symbol, 'name': name} for symbol, name in rows]
+
+    def save_companies(self, companies):
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO companies (symbol, name) VALUES (?, ?) "
+                "ON CONFLICT(symbol) DO UPDATE SET name = excluded.name",
+                [(_['symbol'], _['name']) for _ in companies])
+
+    # Write the given symbols (all of them if symbols is None) in one transaction
+    # Earnings rows are keyed by (symbol, date), so existing events are replaced in place
+    def save(self, sp_dict, symbols=None):
+        symbols = list(sp_dict) if symbols is None else [_ for _ in symbols if _ in sp_dict]
+        with self._lock:
+            with self._db:
+                written = {symbol: self._save_symbol(symbol, sp_dict[symbol]) for symbol in symbols}
+            # Only once the transaction has gone through
+            self._saved_tables.update({symbol: table for symbol, table in written.items() if table is not None})
+
+    # Earnings reaction statistics from stats.EarningsStats, {symbol: {n: {metric: value}}}
+    def load_stats(self):
+        with self._lock:
+            rows = self._db.execute("SELECT symbol, n, metric, value FROM stats").fetchall()
+        stats = {}
+        for symbol, n, metric, value in rows:
+            stats.setdefault(symbol, {}).setdefault(n, {})[metric] = self._nan(value)
+        return stats
+
+    # Replace all stored statistics in one transaction
+    def save_stats(self, stats):
+        rows = [(symbol, n, metric, self._to_float(value))
+                for symbol in stats for n in stats[symbol] for metric, value in stats[symbol][n].items()]
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM stats")
+            self._db.executemany("INSERT INTO stats (symbol, n, metric, value) VALUES (?, ?, ?, ?)", rows)
+
+    # Rewrite the earnings snapshot from the tables in sp_dict, which should match what was just saved
+    def save_snapshot(self, sp_dict):
+        with self._lock:
+            version = self._earnings_version()
+        tables = {symbol: info['table'] for symbol, info in sp_dict.items() if 'table' in info}
+        self._write_snapshot(arrays.EarningsArrays.from_tables(tables), version)
+
+    # Drop companies no longer in the index
+    def remove(self, symbols):
+        with self._lock, self._db:
+            for symbol in symbols:
+                self._db.execute("DELETE FROM companies WHERE symbol = ?", (symbol,))
+                self._db.execute("DELETE FROM earnings WHERE symbol = ?", (symbol,))
+                self._db.execute("DELETE FROM stats WHERE symbol = ?", (symbol,))
+                self._saved_tables.pop(symbol, None)
+            self._bump_earnings_version()
+
+    # Returns the table if its earnings rows were written
+    def _save_symbol(self, symbol, info):
+        # Symbols still waiting for their table are written once it is built
+        if 'table' not in info:
+            return None
+        avg = info.get('avg') or {}
+        self._db.execute(
+            "INSERT INTO companies (symbol, next_earnings, pending_earnings, detail, point_avg, percent_avg, saved_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(symbol) DO UPDATE SET "
+            "next_earnings = excluded.next_earnings, pending_earnings = excluded.pending_earnings, "
+            "detail = excluded.detail, point_avg = excluded.point_avg, percent_avg = excluded.percent_avg, "
+            "saved_at = excluded.saved_at",
+            (symbol, self._from_dates(info.get('next_earnings', [])),
+             self._from_dates(info.get('pending_earnings', [])), info.get('detail'),
+             self._to_float(avg.get('point_avg')), self._to_float(avg.get('percent_avg')),
+             pd.Timestamp.now(tz=self._EASTERN_TZ).isoformat()))
+
+        saved = table = info.get('table')
+        if table is None or len(table) == 0 or table is self._saved_tables.get(symbol):
+            return None
+        # Tables from sp_dict.pickle are still DataFrames
+        if isinstance(table, pd.DataFrame):
+            table = arrays.EarningsView.from_frame(table)
+        # Events that dropped out of the last ten are removed, the rest are upserted
+        dates = [self._from_date(_) for _ in table['Date']]
+        self._db.execute(
+            "DELETE FROM earnings WHERE symbol = ? AND date NOT IN (%s)" % ','.join('?' * len(dates)),
+            (symbol, *dates))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO earnings "
+            "(symbol, date, close_pre, close_post, point_change, percent_change) VALUES (?, ?, ?, ?, ?, ?)",
+            [(symbol, date, *[self._to_float(_) for _ in values]) for date, values in zip(
+                dates, zip(*[table[_] for _ in self._TABLE_COLUMNS[1:]]))])
+        self._bump_earnings_version()
+        return saved
+
+    # Counter bumped with every change to the earnings rows, stored in the snapshot header
+    def _earnings_version(self):
+        return self._db.execute("SELECT value FROM meta WHERE key = 'earnings_version'").fetchone()[0]
+
+    def _bump_earnings_version(self):
+        self._db.execute("UPDATE meta SET value = value + 1 WHERE key = 'earnings_version'")
+
+    # Memory mapped snapshot, None if it is missing or older than the database
+    def _open_snapshot(self, version):
+        header = arrays.read_snapshot_header(self.snapshot_path)
+        if header is None or header[0] != version:
+            return None
+        try:
+            return arrays.EarningsArrays.open_snapshot(self.snapshot_path)
+        except (OSError, ValueError):
+            return None
+
+    def _write_snapshot(self, earnings, version):
+        try:
+            earnings.write_snapshot(self.snapshot_path, version)
+        except OSError:
+            # Windows can't replace a snapshot that is still mapped, it is rewritten on the next start instead
+            pass
+
+    # Dates are stored as ISO strings with their UTC offset
+    def _from_date(self, date):
+        return pd.Timestamp(date).isoformat()
+
+    def _to_date(self, string):
+        date = pd.Timestamp(string)
+        if date.tz is None:
+            return date.tz_localize(self._EASTERN_TZ)
+        return date.tz_convert(self._EASTERN_TZ)
+
+    # next_earnings is a list of zero or one dates
+    def _from_dates(self, dates):
+        return self._from_date(dates[0]) if len(dates) > 0 else None
+
+    def _to_dates(self, string):
+        return [self._to_date(string)] if string else []
+
+    def _to_float(self, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return None if value != value else value
+
+    # Missing averages read back as NaN, the same as a mean over no events
+    def _nan(self, value):
+        return float('nan') if value is None else value
+
+
+# Write-behind layer over SPStore
+# Changed symbols are collected in a dirty set and written together in one transaction
+# once no change has come in for `delay` seconds (or at most `max_delay` after the first change),
+# so a burst of updates costs one commit instead of one per symbol
+# One flusher thread, started with the first change, sleeps until the quiet period is over
+class WriteBehind:
+    def __init__(self, store, sp_dict, delay=2.0, max_delay=10.0):
+        self._store = store
+        self._sp_dict = sp_dict
+        self._delay = delay
+        self._max_delay = max_delay
+        self._dirty = set()
+        # time.monotonic() of the first and the last change since the last flush
+        self._first_dirty = None
+        self._last_dirty = None
+        self._flusher = None
+        self._condition = threading.Condition()
+
+    # Remember a changed symbol, which restarts the quiet period
+    def mark(self, symbol):
+        with self._condition:
+            self._dirty.add(symbol)
+            now = time.monotonic()
+            if self._first_dirty is None:
+                self._first_dirty = now
+                # Only a flusher waiting on an empty dirty set needs waking, the others see the new time themselves
+                self._condition.notify()
+            self._last_dirty = now
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, daemon=True)
+                self._flusher.start()
+
+    # Symbols that left the index are not written back
+    def discard(self, symbols):
+        with self._condition:
+            self._dirty.difference_update(symbols)
+
+    # Write every dirty symbol now, in a single transaction
+    def flush(self):
+        with self._condition:
+            symbols = self._dirty
+            self._dirty = set()
+            self._first_dirty = None
+            self._last_dirty = None
+        if len(symbols) == 0:
+            return
+        try:
+            self._store.save(self._sp_dict, symbols)
+        except Exception:
+            # Keep them dirty so the flusher tries again after another quiet period
+            with self._condition:
+                self._dirty.update(symbols)
+                now = time.monotonic()
+                self._first_dirty = self._first_dirty or now
+                self._last_dirty = self._last_dirty or now
+                self._condition.notify()
+            raise
+
+    # Flusher thread: wait for changes, then until delay has passed without one or max_delay since the first
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._first_dirty is None:
+                        self._condition.wait()
+                        continue
+                    remaining = min(self._last_dirty + self._delay,
+                                    self._first_dirty + self._max_delay) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception:
+                pass
@@ -0,0 +1,121 @@
+# This Table Model file holds the rows of the GUI tables as typed NumPy columns
+# Sorting is a permutation computed from the columns instead of moving Treeview items,
+# so gui.py only has to show the rows that are on screen
+
+import numpy as np
+
+
+# Rows of one table: a key per row, the display values, and one typed array per column
+# Column types are the GUI sort types: 'num' (float64), 'date' (datetime64[D]) and 'name' (str)
+class TableModel:
+    def __init__(self, columns, types, rows=None):
+        self.columns = list(columns)
+        self.types = dict(zip(self.columns, types))
+        self.reset(rows or {})
+
+    # Replace all rows, rows maps key -> display values in column order
+    def reset(self, rows):
+        self._keys = list(rows)
+        self._positions = {key: position for position, key in enumerate(self._keys)}
+        self._values = [tuple(rows[_]) for _ in self._keys]
+        self._data = {column: self._typed(column, [_[index] for _ in self._values])
+                      for index, column in enumerate(self.columns)}
+        # View order as row positions, and the ascending argsort of each column once it is needed
+        self._order = np.arange(len(self._keys))
+        self._argsorts = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    # Key and display values of the row at a position in the current view order
+    def key(self, index):
+        return self._keys[self._order[index]]
+
+    def values(self, index):
+        return self._values[self._order[index]]
+
+    # Display values of the row with a key, None if there is no such row
+    def row(self, key):
+        position = self._positions.get(key)
+        return None if position is None else self._values[position]
+
+    # Display values of every row in view order
+    def rows(self):
+        return [self._values[_] for _ in self._order]
+
+    # Put the rows in the order of a column
+    # Missing values (NaN, NaT) stay at the end either way
+    def sort(self, column, reverse=False):
+        if column not in self._argsorts:
+            self._argsorts[column] = np.argsort(self._data[column], kind='stable')
+        order = self._argsorts[column]
+        if reverse:
+            missing = self._missing(column)[order]
+            order = np.concatenate([order[~missing][::-1], order[missing]])
+        self._order = order
+
+    # Change a row in place or add it at the end of the view, returns True for a new row
+    # The view order is kept so rows don't jump around while they update, the next sort uses the new values
+    def set_row(self, key, values):
+        values = tuple(values)
+        self._argsorts.clear()
+        if key in self._positions:
+            position = self._positions[key]
+            self._values[position] = values
+            for index, column in enumerate(self.columns):
+                self._data[column][position] = self._typed(column, [values[index]])[0]
+            return False
+
+        position = len(self._keys)
+        self._keys.append(key)
+        self._positions[key] = position
+        self._values.append(values)
+        for index, column in enumerate(self.columns):
+            self._data[column] = np.concatenate([self._data[column], self._typed(column, [values[index]])])
+        self._order = np.append(self._order, position)
+        return True
+
+    def remove_row(self, key):
+        if key not in self._positions:
+            return
+        position = self._positions.pop(key)
+        self._argsorts.clear()
+        del self._keys[position]
+        del self._values[position]
+        for column in self.columns:
+            self._data[column] = np.delete(self._data[column], position)
+        self._positions = {key: index for index, key in enumerate(self._keys)}
+        order = self._order[self._order != position]
+        self._order = np.where(order > position, order - 1, order)
+
+    def _missing(self, column):
+        data = self._data[column]
+        if self.types[column] == 'num':
+            return np.isnan(data)
+        if self.types[column] == 'date':
+            return np.isnat(data)
+        return np.zeros(len(data), dtype=bool)
+
+    # Display values as a typed array, values that don't parse are missing
+    def _typed(self, column, values):
+        kind = self.types[column]
+        if kind == 'num':
+            return np.array([_to_float(_) for _ in values], dtype=np.float64)
+        if kind == 'date':
+            return np.array([_to_day(_) for _ in values], dtype='datetime64[D]')
+        return np.array([str(_) for _ in values], dtype=object)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+# Dates are shown as YYYY-MM-DD strings
+def _to_day(value):
+    try:
+        return np.datetime64(str(value)[:10], 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
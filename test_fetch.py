@@ -0,0 +1,128 @@
+# This Test file checks the retries, rate limits and circuit breaker of fetch.AsyncFetcher
+# A local stand-in server answers with the errors a test lines up, no network is needed:
+#     python -m unittest test_fetch
+
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fetch
+
+
+# Answers each request with the next (status, headers) the test lined up, then with 200s
+class _ErrorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(time.monotonic())
+            status, headers = server.responses.pop(0) if server.responses else (200, {})
+        body = b'ok' if status == 200 else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _ErrorHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/page' % self.server.server_address[1]
+        # Policies of its own, so the host's bucket and breaker start fresh in every test
+        self.policies = fetch.HostPolicies()
+        self.breaker = self.policies.get('127.0.0.1').breaker
+        self.breaker.COOLDOWN = 0.5
+        self.fetchers = []
+
+    def tearDown(self):
+        for fetcher in self.fetchers:
+            fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetcher(self, retries=3, deadline=10):
+        fetcher = fetch.AsyncFetcher(rate_limits={}, cache=False, deadline=deadline, policies=self.policies)
+        fetcher.RETRIES = retries
+        # Short backoff so failing tests don't sit through seconds of waiting
+        fetcher.BACKOFF = 0.01
+        fetcher.MAX_BACKOFF = 0.05
+        self.fetchers.append(fetcher)
+        return fetcher
+
+    def fail_with(self, status, count, headers=None):
+        self.server.responses.extend([(status, headers or {})] * count)
+
+    def test_503_is_retried_until_the_page_comes(self):
+        self.fail_with(503, 2)
+        self.assertEqual(self.fetcher().fetch(self.url), b'ok')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_give_up_after_the_last_attempt(self):
+        self.fail_with(503, 10)
+        self.assertIsNone(self.fetcher(retries=2).fetch(self.url))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_404_is_not_retried(self):
+        self.fail_with(404, 1)
+        self.assertIsNone(self.fetcher().fetch(self.url))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_429_waits_for_retry_after(self):
+        self.fail_with(429, 1, {'Retry-After': '1'})
+        self.assertEqual(self.fetcher().fetch(self.url), b'ok')
+        first, second = self.server.requests
+        self.assertGreaterEqual(second - first, 0.9)
+        # A 429 means the host is busy, not down
+        self.assertFalse(self.breaker.open)
+
+    def test_429_slows_the_host_down(self):
+        bucket = self.policies.get('127.0.0.1').bucket
+        rate = bucket.rate
+        self.fail_with(429, 1, {'Retry-After': '0'})
+        self.fetcher().fetch(self.url)
+        self.assertLess(bucket.rate, rate)
+
+    def test_breaker_opens_waits_out_its_cooldown_and_closes(self):
+        fetcher = self.fetcher(retries=fetch.CircuitBreaker.THRESHOLD - 1)
+        self.fail_with(503, fetch.CircuitBreaker.THRESHOLD)
+        self.assertIsNone(fetcher.fetch(self.url))
+        self.assertTrue(self.breaker.open)
+
+        # The next request waits for the cooldown and is the trial that closes the breaker
+        opened = self.server.requests[-1]
+        self.assertEqual(fetcher.fetch(self.url), b'ok')
+        self.assertGreaterEqual(self.server.requests[-1] - opened, self.breaker.COOLDOWN - 0.05)
+        self.assertFalse(self.breaker.open)
+
+    def test_open_breaker_fails_requests_it_would_make_miss_their_deadline(self):
+        self.fail_with(503, fetch.CircuitBreaker.THRESHOLD)
+        self.fetcher(retries=fetch.CircuitBreaker.THRESHOLD - 1).fetch(self.url)
+        requests = len(self.server.requests)
+
+        start = time.monotonic()
+        self.assertIsNone(self.fetcher(deadline=0.2).fetch(self.url))
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_waiting_requests_all_go_through_after_one_trial(self):
+        self.fail_with(503, fetch.CircuitBreaker.THRESHOLD)
+        fetcher = self.fetcher(retries=fetch.CircuitBreaker.THRESHOLD - 1)
+        fetcher.fetch(self.url)
+        self.breaker.POLL = 0.05
+
+        futures = [fetcher.submit(self.url) for _ in range(5)]
+        self.assertEqual([_.result() for _ in futures], [b'ok'] * 5)
+        self.assertFalse(self.breaker.open)
+
+
+if __name__ == '__main__':
+    unittest.main()
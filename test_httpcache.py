@@ -0,0 +1,110 @@
+# This Test file checks the on-disk HTTP cache in httpcache.py through fetch.AsyncFetcher
+# A local stand-in server counts the requests that actually reach it, no network is needed:
+#     python -m unittest test_httpcache
+
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fetch
+import httpcache
+
+
+# Serves one page with an ETag, answers a matching If-None-Match with a 304
+# and every request with a 503 once the test sets down
+class _PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get('If-None-Match'))
+        if server.down:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _PageHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.down = False
+        self.server.etag = '"v1"'
+        self.server.body = b'<html>page</html>'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/page' % self.server.server_address[1]
+        self.path = tempfile.mkdtemp()
+        self.fetchers = []
+
+    def tearDown(self):
+        for fetcher in self.fetchers:
+            fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    # ttl is the seconds a cached page is served without a request, 0 revalidates every time
+    def fetcher(self, ttl):
+        cache = httpcache.HTTPCache(self.path, ttls={'127.0.0.1': ttl})
+        fetcher = fetch.AsyncFetcher(rate_limits={}, cache=cache, deadline=10, policies=fetch.HostPolicies())
+        # A 503 is final here, so the stale fallback doesn't sit through the retry backoff
+        fetcher.RETRIES = 0
+        self.fetchers.append(fetcher)
+        return fetcher
+
+    def test_fresh_page_is_served_without_a_request(self):
+        fetcher = self.fetcher(ttl=3600)
+        self.assertEqual(fetcher.fetch(self.url), self.server.body)
+        self.assertEqual(fetcher.fetch(self.url), self.server.body)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_expired_page_is_revalidated_with_its_etag(self):
+        fetcher = self.fetcher(ttl=0)
+        body = self.server.body
+        self.assertEqual(fetcher.fetch(self.url), body)
+        # The server would send a different body, so getting the old one back means the 304 was used
+        self.server.body = b'<html>not sent</html>'
+        self.assertEqual(fetcher.fetch(self.url), body)
+        self.assertEqual(self.server.requests, [None, '"v1"'])
+
+    def test_changed_page_replaces_the_cached_one(self):
+        fetcher = self.fetcher(ttl=0)
+        fetcher.fetch(self.url)
+        self.server.etag = '"v2"'
+        self.server.body = b'<html>new page</html>'
+        self.assertEqual(fetcher.fetch(self.url), b'<html>new page</html>')
+        self.assertEqual(fetcher.fetch(self.url), b'<html>new page</html>')
+        self.assertEqual(self.server.requests, [None, '"v1"', '"v2"'])
+
+    def test_stale_page_is_served_when_the_server_fails(self):
+        fetcher = self.fetcher(ttl=0)
+        body = fetcher.fetch(self.url)
+        self.server.down = True
+        self.assertEqual(fetcher.fetch(self.url), body)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_failed_page_without_a_cached_copy_is_none(self):
+        fetcher = self.fetcher(ttl=0)
+        self.server.down = True
+        self.assertIsNone(fetcher.fetch(self.url))
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()